@@ -1,8 +1,32 @@
 #!/usr/bin/python
 
 import sys
+import os
 import re
+import sre_parse
+import sre_compile
+import _sre
+import mmap
+import heapq
+import calendar
+import math
+import operator
+import time
+import tempfile
+import threading
+import itertools
+import collections
+import multiprocessing
+import Queue
+import cPickle
+import hashlib
+import glob
+import sqlite3
+import json
+import bisect
+import BaseHTTPServer
 from datetime import datetime, date
+from stat import S_IWGRP, S_IWOTH
 
 ################################################################################
 # Common regular expressions
@@ -84,6 +108,15 @@ uid_re="uid=([0-9]+)"
 # SPAM identifier when dropped by amavis
 spam_id_re="id=([0-9-]+)"
 
+# Program name, like postfix/smtpd or postfix/amavisd/smtpd
+program_re = "([^ \[]+)"
+
+# Syslog header that starts every line: date, host name, program and PID
+header_re = "^" + date_re + " " + hostname_re + " " + program_re + pid_re + ": "
+
+# Part of the header that precedes program name in every rule
+rule_prefix_re = "^" + date_re + " " + hostname_re + " "
+
 ################################################################################
 # Regular expressions
 ################################################################################
@@ -840,6 +873,12 @@ class MailMessage:
 
 		self.message = {}
 
+		# Set when the message is removed before it was done
+		self.expired = False
+
+		# Node of the message in QueueIDGenealogy, assigned when needed
+		self.node = None
+
 		self.message["source"] = source
 		self.message["clienthostname"] = clienthostname
 		self.message["clienthostip"] = clienthostip
@@ -857,6 +896,9 @@ class MailMessage:
 
 		# All log records belonging to a single Queue ID
 
+	def __str__(self):
+		return "[{}QUEUEID {}] messageid={} from={} -> {}".format("EXPIRED " if self.expired else "", self.getQueueID(), self.getMessageID(), self.getMailFrom(), self.message["instances"].keys())
+
 	def getMessageID(self):
 		if self.message.has_key("messageid"):
 			return self.message["messageid"]
@@ -869,6 +911,12 @@ class MailMessage:
 
 		return ""
 
+	def getHostname(self):
+		if self.message["logRecords"]:
+			return self.message["logRecords"][0]["hostname"]
+
+		return ""
+
 	def getNewQueueIDs(self):
 
 		if self.message.has_key("dsn_queueids"):
@@ -884,6 +932,24 @@ class MailMessage:
 
 		return newqueueids
 
+	def getChildQueueIDs(self):
+		"""
+		Return queue IDs of messages that were created from this one, i.e.
+		reinjected after content filtering or relayed, and delivery status
+		notifications, as (queueid, relayhostname) pairs. Relay host name is
+		None for notifications, which are created on the same host.
+		"""
+
+		children = []
+		for msginstance in self.message["instances"].values():
+			if msginstance.newqueueid is not None:
+				children.append((msginstance.newqueueid, msginstance.relayhostname))
+
+		for queueid in self.message.get("dsn_queueids", []):
+			children.append((queueid, None))
+
+		return children
+
 	def getMailFrom(self):
 		if self.message.has_key("mail_from"):
 			return self.message["mail_from"]
@@ -919,7 +985,7 @@ class MailMessage:
 					self.message["mail_from"] = mail_from
 
 				if logRecord.has_key("orig_to"):
-					raise
+					raise UnexpectedEventLogParserException("Unexpected orig_to in input: {}".format(logRecord["all"]))
 
 				rcpt_to = (logRecord["to"], None)
 				if not self.message["instances"].has_key(rcpt_to):
@@ -935,7 +1001,7 @@ class MailMessage:
 					self.message["mail_from"] = mail_from
 
 				if logRecord.has_key("orig_to"):
-					raise
+					raise UnexpectedEventLogParserException("Unexpected orig_to in input: {}".format(logRecord["all"]))
 
 				rcpt_to = (logRecord["to"], None)
 				if not self.message["instances"].has_key(rcpt_to):
@@ -951,7 +1017,7 @@ class MailMessage:
 					self.message["mail_from"] = mail_from
 
 				if logRecord.has_key("orig_to"):
-					raise
+					raise UnexpectedEventLogParserException("Unexpected orig_to in input: {}".format(logRecord["all"]))
 
 				rcpt_to = (logRecord["to"], None)
 				if not self.message["instances"].has_key(rcpt_to):
@@ -987,7 +1053,7 @@ class MailMessage:
 			elif logRecord["regex"]["name"] in ("message_deferred_smtp", "message_deferred_error"):
 
 				if logRecord.has_key("orig_to"):
-					raise
+					raise UnexpectedEventLogParserException("Unexpected orig_to in input: {}".format(logRecord["all"]))
 
 				to = (logRecord["to"], None)
 				if not self.message["instances"].has_key(to):
@@ -997,7 +1063,7 @@ class MailMessage:
 			elif logRecord["regex"]["name"] in ("message_bounced_smtp", "message_bounced_error"):
 
 				if logRecord.has_key("orig_to"):
-					raise
+					raise UnexpectedEventLogParserException("Unexpected orig_to in input: {}".format(logRecord["all"]))
 
 				to = (logRecord["to"], None)
 				if not self.message["instances"].has_key(to):
@@ -1030,14 +1096,14 @@ class MailMessage:
 			elif logRecord["regex"]["name"] == "message_expired":
 
 				if logRecord.has_key("orig_to"):
-					raise
+					raise UnexpectedEventLogParserException("Unexpected orig_to in input: {}".format(logRecord["all"]))
 
 				self.state = self.MSG_EXPIRED
 
 			elif logRecord["regex"]["name"] in ("delivery_status_error", "delivery_status_success"):
 
 				if logRecord.has_key("orig_to"):
-					raise
+					raise UnexpectedEventLogParserException("Unexpected orig_to in input: {}".format(logRecord["all"]))
 
 				if not self.message.has_key("dsn_queueids"):
 					self.message["dsn_queueids"] = []
@@ -1357,273 +1423,4178 @@ class AmavisdProcess():
 		return None, None
 
 ################################################################################
-# Main classes
+# Utility functions
 ################################################################################
 
-class ZimbraMailLog():
+def splitRuleRegex(regex):
+	"""
+	Split regular expression of a rule into the name of the program the
+	rule applies to and the regular expression for the rest of the line,
+	i.e. the part that follows "program[PID]: ".
+	"""
 
-	def __init__(self):
+	start = len(rule_prefix_re)
+	end = regex.find(pid_re + ": ", start)
+	if not regex.startswith(rule_prefix_re) or end == -1:
+		raise InternalLogParserException("Rule doesn't start with a syslog header: {}".format(regex))
 
-		self.regex = zimbra8
-		for regex in zimbra8:
-			regex["cregex"] = re.compile(regex["regex"] + "$")
+	program = regex[start:end]
+	if not re.match(program_re + "$", program) or re.search(r"[\\.^$*+?{}()|]", program):
+		raise InternalLogParserException("Rule doesn't have a literal program name: {}".format(regex))
 
-		# For generators of mail messages
-		self.stateProcessPID = {}
+	return program, regex[end + len(pid_re) + 2:]
 
-		# All the messages with assigned queueid currently being processed
-		self.mailMessagesByQueueID = {}
+def literalPrefix(regex):
+	"""
+	Return the literal text every string matched by the regular
+	expression has to start with. Empty string is returned if there is
+	no such text.
+	"""
 
-		# All the processed messages
-		self.processedMessages = []
+	prefix = ""
+	i = 0
+	while i < len(regex):
+		c = regex[i]
+		if c == "\\":
+			if i + 1 == len(regex) or regex[i + 1].isalnum():
+				break
+			c = regex[i + 1]
+			i += 1
+		elif c in ".^$*+?{}[]|()":
+			# A quantifier makes the last character optional
+			if c in "*?{":
+				prefix = prefix[:-1]
+			break
+		prefix += c
+		i += 1
+	else:
+		return prefix
+
+	if i + 1 < len(regex) and regex[i + 1] in "*?{":
+		prefix = prefix[:-1]
+
+	# Alternatives at the top level might start with anything
+	depth = 0
+	inClass = False
+	i = 0
+	while i < len(regex):
+		c = regex[i]
+		if c == "\\":
+			i += 1
+		elif inClass:
+			inClass = c != "]"
+		elif c == "[":
+			inClass = True
+		elif c == "(":
+			depth += 1
+		elif c == ")":
+			depth -= 1
+		elif c == "|" and depth == 0:
+			return ""
+		i += 1
+
+	return prefix
+
+def ruleKey(regex):
+	"""
+	Return the first word of the literal prefix of rule's body, or None if
+	the literal prefix doesn't contain a complete word. Any line matched
+	by the rule has the returned word as the first word of its body.
+	"""
 
-	def parseLog(self, fileLikeObject):
+	prefix = literalPrefix(regex)
+	if " " not in prefix:
+		return None
 
-		# To count line number
-		lineCounter = 0
+	return prefix[:prefix.index(" ")]
 
-		logYear = datetime.today().year
+################################################################################
+# Rule compiler
+################################################################################
 
-		for line in fileLikeObject:
-			lineCounter += 1
-			if lineCounter % 10000 == 0: print lineCounter 
+def namedRuleRegex(name, body, fields):
+	"""
+	Return the body of a rule with its groups named by the fields of the
+	body. fields has a name, or an empty string for an unnamed group, for
+	every group of the body from the first one on.
+	"""
 
-			for regex in self.regex:
-				res = regex["cregex"].match(line)
-				if not res:
-					continue
+	result = []
+	group = 0
+	inClass = False
+	i = 0
+	while i < len(body):
+		c = body[i]
+		result.append(c)
+		if c == "\\":
+			result.append(body[i + 1])
+			i += 1
+		elif inClass:
+			inClass = c != "]"
+		elif c == "[":
+			inClass = True
+		elif c == "(" and body[i + 1:i + 2] != "?":
+			if group < len(fields) and fields[group]:
+				result.append("?P<{}>".format(fields[group]))
+			group += 1
+		i += 1
+
+	if len(fields) > group:
+		raise InternalLogParserException("Rule {} has {} fields for {} groups of its body".format(name, len(fields), group))
+
+	return "".join(result)
+
+def groupExtractor(numbers):
+	"""
+	Return a function that gives the values of the groups with the given
+	numbers of a match object, as a tuple.
+	"""
 
-				if regex.has_key("print") and regex["print"]:
-					print regex["name"]
-					print res.group()
-					print res.groups()
-					print
-					sys.exit(1)
+	if len(numbers) > 1:
+		return operator.methodcaller("group", *numbers)
 
-				break
+	if numbers:
+		number = numbers[0]
+		return lambda res: (res.group(number),)
 
-			else:
-				raise UnexpectedEventLogParserException("LINE({}): {}".format(lineCounter, line))
+	return lambda res: ()
 
-			# Create dictionary from "fields" data
-			parsed_message = {}
-			parsed_message["regex"] = regex
-			for k,v in zip(regex["fields"], xrange(len(regex["fields"]))):
+class RuleCache():
+	"""
+	This class compiles regular expressions of the rules, and keeps the
+	compiled code in a file in the given directory, so that later runs
+	don't need to compile them again. Compiling all the rules takes about
+	0.1 s, which is noticeable for short runs.
+
+	The name of the file contains a hash of the rules, the header and the
+	Python version, so any change of the rules makes a new file. If the
+	directory is None, or the file can't be read or written, regular
+	expressions are simply compiled.
+
+	The file is JSON, so reading it can't run any code. It is used only if
+	it is owned by the current user and nobody else can write to it, and
+	every entry must have the layout of the arguments of _sre.compile.
+	The code itself is checked by _sre.compile, and if it is rejected,
+	the regular expression is compiled again.
+	"""
 
-				# Special processing for timestamp
-				if k == "timestamp":
-					parsed_message["timestamp"] = datetime.strptime(res.group(v), "%b %d %H:%M:%S").replace(logYear)
-				else:
-					if len(k): parsed_message[k] = res.group(v)
+	VERSION = 2
 
-			if regex["smid"] == "POSTFIX":
+	def __init__(self, directory, rules):
 
-				pid = parsed_message["PID"]
-				if not self.stateProcessPID.has_key(pid):
-					self.stateProcessPID[pid] = PostfixProcess(pid)
-				cmd, arg = self.stateProcessPID[pid].process(parsed_message)
+		key = hashlib.sha1(repr((self.VERSION, sys.version, _sre.MAGIC, header_re,
+			[(regex["name"], regex["regex"], regex["fields"]) for regex in rules]))).hexdigest()
 
-				if cmd == CMD_MSGADD:
-					self.mailMessagesByQueueID[parsed_message["queueid"]] = arg
-				elif cmd == CMD_MSGERR:
-					try:
-						self.mailMessagesByQueueID[arg].process(parsed_message)
-					except:
-						print parsed_message["all"]
-						sys.exit(1)
-					self.processedMessages.append(self.mailMessagesByQueueID[arg])
-					del self.mailMessagesByQueueID[arg]
-				elif cmd == CMD_PIDDEL:
-					del self.stateProcessPID[pid]
-				elif cmd is not None:
-					raise UnexpectedEventLogParserException("Unhandled command: {}".format(cmd))
-
-			elif regex["smid"] == "DKIMMILTER":
-
-				pid = parsed_message["PID"]
-				if not self.stateProcessPID.has_key(pid):
-					self.stateProcessPID[pid] = DKIMMilterProcess(pid)
-
-				cmd, arg = self.stateProcessPID[pid].process(parsed_message)
-
-				if cmd == CMD_MSGADD:
-					self.mailMessagesByQueueID[parsed_message["queueid"]] = arg
-				elif cmd == CMD_PIDDEL:
-					del self.stateProcessPID[pid]
-				elif cmd is not None:
-					raise UnexpectedEventLogParserException("Unhandled command: {}".format(cmd))
-
-			elif regex["smid"] == "AMAVISD":
-
-				pid = parsed_message["PID"]
-				if not self.stateProcessPID.has_key(pid):
-					self.stateProcessPID[pid] = AmavisdProcess(pid)
-				cmd, arg = self.stateProcessPID[pid].process(parsed_message)
-
-				if cmd == CMD_MSGADD:
-					self.mailMessagesByQueueID[parsed_message["queueid"]] = arg
-				elif cmd == CMD_PIDDEL:
-					del self.stateProcessPID[pid]
-				elif cmd is not None:
-					raise UnexpectedEventLogParserException("Unhandled command: {}".format(cmd))
-
-			elif regex["smid"] == "queueid":
-
-				queueid = parsed_message["queueid"]
-				if not self.mailMessagesByQueueID.has_key(queueid):
-
-					if regex["name"] == "messageid_identified":
-						# It can happen than postfix/cleanup generates a new message in
-						# response to some error. So, we handle that case here by
-						# creating a new mail message object.
-						self.mailMessagesByQueueID[queueid] = MailMessage(INTERNAL, queueid)
-
-					elif regex["name"] == "pickup":
-						# This handles localy generated mail messages
-						#
-						# Note that we don't pass queueid to constructor since we'll call
-						# process method a bit later!
-						self.mailMessagesByQueueID[queueid] = MailMessage(LOCAL)
+		self.filename = None
+		if directory is not None:
+			self.filename = os.path.join(directory, "rules-{}.json".format(key[:16]))
 
-					else:
-						# This point is reached for messages that arrived before the
-						# current log was started. Those messages we ignore for now,
-						# but maybe we should collect them too.
-						continue
-						raise UnexpectedEventLogParserException("Unhandled queueid: {}".format(queueid))
+		self.codes = {}
+		self.changed = False
+		if self.filename is not None and os.path.exists(self.filename):
+			try:
+				with open(self.filename, "rb") as f:
+					if self.trusted(os.fstat(f.fileno())):
+						self.codes = self.decode(json.load(f))
+			except (IOError, ValueError):
+				self.codes = {}
 
-				elif regex["name"] == "messageid_identified":
+	@staticmethod
+	def defaultDirectory():
+		return os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "LogParser")
 
-					# It happens that previous message "dissapeared" and then a new one
-					# appears, with different messageid, and being a different message.
-					# So to take into account that case, we first check that message id
-					# is different (safegard), then we "retire" the old message, and we
-					# instatiate a new message.
-					oldmsgid = self.mailMessagesByQueueID[queueid].getMessageID()
-					if oldmsgid != "" and oldmsgid != parsed_message["messageid"]:
-						self.processedMessages.append(self.mailMessagesByQueueID[queueid])
-						self.mailMessagesByQueueID[queueid] = MailMessage(INTERNAL, queueid)
+	@staticmethod
+	def trusted(st):
+		"""
+		Return True if a file with the given stat result is owned by the
+		current user and only writable by them.
+		"""
 
-				cmd, arg = self.mailMessagesByQueueID[queueid].process(parsed_message)
+		return st.st_uid == os.getuid() and not st.st_mode & (S_IWGRP | S_IWOTH)
 
-				if cmd == CMD_MSGDONE:
-					self.processedMessages.append(self.mailMessagesByQueueID[queueid])
-					del self.mailMessagesByQueueID[queueid]
+	@staticmethod
+	def decode(cached):
+		"""
+		Return the codes read from a cache file, with strings as str. Raises
+		ValueError if they don't have the expected layout.
+		"""
 
-				elif cmd is not None:
-					raise UnexpectedEventLogParserException("Unhandled command: {}".format(cmd))
+		if not isinstance(cached, dict):
+			raise ValueError("not a dictionary")
+
+		codes = {}
+		for pattern, args in cached.iteritems():
+			if not isinstance(args, list) or len(args) != 6:
+				raise ValueError("wrong arguments")
+			source, flags, code, groups, groupindex, indexgroup = args
+			if source != pattern or not isinstance(flags, int) or not isinstance(groups, int):
+				raise ValueError("wrong pattern")
+			if not isinstance(code, list) or not all(isinstance(c, (int, long)) for c in code):
+				raise ValueError("wrong code")
+			if not isinstance(groupindex, dict) or not all(isinstance(i, int) for i in groupindex.itervalues()):
+				raise ValueError("wrong group index")
+			if not isinstance(indexgroup, list) or not all(name is None or isinstance(name, basestring) for name in indexgroup):
+				raise ValueError("wrong group names")
+
+			pattern = pattern.encode("utf-8")
+			groupindex = dict((name.encode("utf-8"), index) for name, index in groupindex.iteritems())
+			indexgroup = [name if name is None else name.encode("utf-8") for name in indexgroup]
+			codes[pattern] = (pattern, flags, code, groups, groupindex, indexgroup)
+
+		return codes
+
+	def compile(self, pattern):
+		"""
+		Compile a regular expression, or make it from the cached code.
+		"""
 
-	def dumpProcessedMessages(self):
+		args = self.codes.get(pattern)
+		if args is not None:
+			try:
+				return _sre.compile(*args)
+			except (RuntimeError, TypeError, OverflowError):
+				# Code that doesn't pass the checks of _sre
+				pass
 
-		for msg in self.processedMessages:
-			print "[QUEUEID {}] messageid={} newqueueid={}".format(msg.getQueueID(), msg.getMessageID(), msg.getNewQueueIDs())
+		# What sre_compile.compile does, keeping its arguments to _sre
+		tree = sre_parse.parse(pattern)
+		groupindex = tree.pattern.groupdict
+		indexgroup = [None] * tree.pattern.groups
+		for name, index in groupindex.items():
+			indexgroup[index] = name
+		args = (pattern, tree.pattern.flags, sre_compile._code(tree, 0), tree.pattern.groups - 1, groupindex, indexgroup)
 
-	def dumpUnprocessedMessages(self):
+		self.codes[pattern] = args
+		self.changed = True
+		return _sre.compile(*args)
 
-		for queueid, msg in self.mailMessagesByQueueID.items():
-			print "[QUEUEID {}] messageid={}".format(queueid, msg.getMessageID())
+	def save(self):
+		"""
+		Write the cache if anything was compiled.
+		"""
 
-	def dumpNewQueueIDs(self):
+		if self.filename is None or not self.changed:
+			return
 
-		for msg in self.processedMessages:
-			print "[MESSAGEID {}] newqueueids={}".format(msg.getMessageID, msg.getNewQueueID())
+		try:
+			directory = os.path.dirname(self.filename)
+			if not os.path.isdir(directory):
+				os.makedirs(directory, 0700)
+			fd, name = tempfile.mkstemp(dir=directory)
+			with os.fdopen(fd, "wb") as f:
+				json.dump(self.codes, f)
+			os.rename(name, self.filename)
+		except (IOError, OSError):
+			return
 
-	def consolidateMessagesByMessageID(self):
+		self.changed = False
+
+def compileRules(rules, compile=re.compile):
+	"""
+	Check the rules and add to every one what is needed to match it: its
+	id, the program, the body that follows the header, the number of
+	groups of the body and the key (see ruleKey). The body is compiled
+	with groups named by the fields into "pattern", which also makes sure
+	that the fields fit the groups. Values of the named fields are given
+	by "values" for a match of the pattern, by "extract" for the tuple of
+	groups of the complete regular expression, and "index" gives the
+	position of every field in a LogRecord.
+
+	Returns the rules by program, in the same order as they are given.
+	"""
+
+	rulesByProgram = {}
+	for ruleid, regex in enumerate(rules):
+		if regex["fields"][:4] != ("all", "timestamp", "hostname", "PID"):
+			raise InternalLogParserException("Rule {} doesn't start with the header fields".format(regex["name"]))
+
+		program, body = splitRuleRegex(regex["regex"])
+		regex["id"] = ruleid
+		regex["program"] = program
+		regex["body"] = body
+		regex["key"] = ruleKey(body)
+
+		try:
+			pattern = compile(namedRuleRegex(regex["name"], body, regex["fields"][4:]) + "$")
+		except re.error as e:
+			raise InternalLogParserException("Rule {}: {}".format(regex["name"], e))
+		regex["pattern"] = pattern
+		regex["groups"] = pattern.groups
+
+		# Field names and the numbers of groups of the body with named
+		# fields, which have to be the ones the names were given to
+		regex["names"] = [k for k in regex["fields"] if len(k)]
+		regex["namedGroups"] = tuple(i + 1 for i, k in enumerate(regex["fields"][4:]) if len(k))
+		if tuple(pattern.groupindex[k] for k in regex["names"][4:]) != regex["namedGroups"]:
+			raise InternalLogParserException("Rule {} has fields that don't match its groups".format(regex["name"]))
+
+		regex["values"] = groupExtractor(regex["namedGroups"])
+		regex["extract"] = operator.itemgetter(*[v for k, v in zip(regex["fields"], xrange(len(regex["fields"]))) if len(k)])
+		regex["index"] = dict((k, i) for i, k in enumerate(regex["names"]))
+
+		rulesByProgram.setdefault(program, []).append(regex)
+
+	return rulesByProgram
+
+################################################################################
+# Timestamps
+################################################################################
+
+MONTHS = {"Jan": 1, "Feb": 2, "Mar": 3, "Apr": 4, "May": 5, "Jun": 6,
+	"Jul": 7, "Aug": 8, "Sep": 9, "Oct": 10, "Nov": 11, "Dec": 12}
+
+class TimestampDecoder():
+	"""
+	This class decodes syslog timestamps, like "Jul  7 03:03:45", into
+	datetime objects or, if epoch is True, into integer seconds since the
+	epoch (the timestamps are local time, so they are treated as if they
+	were in UTC).
+
+	Syslog timestamps don't have a year. The year of the first timestamp
+	is chosen so that the timestamp isn't after the reference time, which
+	should be the time the log was last written to, i.e. the current time
+	for the live log or modification time for an archived log. After that,
+	the year is incremented whenever the month wraps around from the end
+	to the beginning of the year. February 29 is taken to be from the last
+	leap year up to the inferred one; when it is the first timestamp, the
+	following ones are in that year too.
+
+	Consecutive lines usually have the same timestamp, so the last decoded
+	timestamp is remembered and returned without parsing it again.
+	"""
+
+	def __init__(self, reference=None, epoch=False):
+		self.reference = reference
+		self.epoch = epoch
+		self.year = None
+		self.month = None
+		self.lastTimestamp = None
+		self.lastValue = None
+		self.lastEpoch = None
+
+	def decode(self, timestamp):
+
+		if timestamp == self.lastTimestamp:
+			return self.lastValue
+
+		month, day, clock = timestamp.split()
+		month = MONTHS[month]
+		day = int(day)
+		hour, minute, second = [int(x) for x in clock.split(":")]
+
+		if self.year is None:
+			reference = self.reference or datetime.now()
+			self.year = reference.year
+			if (month, day, hour, minute, second) > reference.timetuple()[1:6]:
+				self.year -= 1
+			if month == 2 and day == 29:
+				while not calendar.isleap(self.year):
+					self.year -= 1
+			self.month = month
+
+		year = self.year
+		if self.month - month > 6:
+			# The month wrapped around, so this is the new year
+			self.year += 1
+			self.month = month
+			year = self.year
+		elif month - self.month > 6:
+			# A late line from the previous year
+			year -= 1
+		else:
+			self.month = month
+
+		if month == 2 and day == 29:
+			while not calendar.isleap(year):
+				year -= 1
+
+		self.lastEpoch = calendar.timegm((year, month, day, hour, minute, second))
+		if self.epoch:
+			self.lastValue = self.lastEpoch
+		else:
+			self.lastValue = datetime(year, month, day, hour, minute, second)
+		self.lastTimestamp = timestamp
+
+		return self.lastValue
+
+################################################################################
+# Log records
+################################################################################
+
+class LogRecord(object):
+	"""
+	This class holds the fields of a single parsed log line. Only the index
+	of the matching rule in zimbra8 and the values of the rule's named
+	fields are stored. Fields are accessed like in a dictionary, using the
+	names from the rule's "fields", while "regex" returns the rule itself.
+	"""
+
+	__slots__ = ("ruleid", "values")
+
+	def __init__(self, ruleid, values):
+		self.ruleid = ruleid
+		self.values = values
+
+	def __getitem__(self, key):
+		if key == "regex":
+			return zimbra8[self.ruleid]
+
+		return self.values[zimbra8[self.ruleid]["index"][key]]
+
+	def has_key(self, key):
+		return key == "regex" or key in zimbra8[self.ruleid]["index"]
+
+	__contains__ = has_key
+
+	def get(self, key, default=None):
+		if key in zimbra8[self.ruleid]["index"] or key == "regex":
+			return self[key]
+
+		return default
+
+	def keys(self):
+		return ["regex"] + zimbra8[self.ruleid]["names"]
+
+	def __repr__(self):
+		return repr(dict((k, self[k]) for k in zimbra8[self.ruleid]["names"]))
+
+class LineRefLogRecord(LogRecord):
+	"""
+	This class is a LogRecord that doesn't keep the text of the line.
+	Instead, it has the log file, byte offset and length of the line, and
+	reads the line back from the log file when "all" field is accessed.
+	"""
+
+	__slots__ = ("logFile", "offset", "length")
+
+	def __init__(self, ruleid, values, logFile, offset, length):
+		LogRecord.__init__(self, ruleid, values)
+		self.logFile = logFile
+		self.offset = offset
+		self.length = length
+
+	def __getitem__(self, key):
+		if key == "all":
+			return self.logFile.read(self.offset, self.length)
+
+		return LogRecord.__getitem__(self, key)
+
+class LogFile():
+	"""
+	This class gives access to lines of a log file by their byte offsets
+	through a memory mapped view of the file.
+
+	Plain log files are mapped directly. Anything else, e.g. decompressed
+	content of a compressed log, is spooled into a temporary file while
+	it is being parsed, and the temporary file is mapped instead.
+	"""
+
+	def __init__(self, fileLikeObject):
+
+		self.map = None
+
+		if type(fileLikeObject) is file and os.path.isfile(fileLikeObject.name):
+			self.file = open(fileLikeObject.name, "rb")
+			self.spool = False
+			self.offset = fileLikeObject.tell()
+		else:
+			self.file = tempfile.TemporaryFile()
+			self.spool = True
+			self.offset = 0
+
+	def append(self, line):
 		"""
-		The purpose of this method is to generate a list of messages that
-		are originating ones, i.e. they came from the outside of the
-		system. The consolidation is done using message ID as it is the
-		most reliable way to determine messages.
+		Account for the next line read from the log, and return its offset.
 		"""
 
-		self.messagesByMessageID = {}
-		for msg in self.processedMessages:
+		offset = self.offset
+		self.offset += len(line)
+		if self.spool:
+			self.file.write(line)
 
-			msgid = msg.getMessageID()
-			if not self.messagesByMessageID.has_key(msgid):
-				self.messagesByMessageID[msgid] = []
+		return offset
 
-			self.messagesByMessageID[msgid].append(msg)
+	def mapAll(self):
+		"""
+		Map the whole file and return the map, or None if the file is
+		empty.
+		"""
 
-	def dumpMessagesByMessageID(self):
+		if self.spool:
+			self.file.flush()
+		if os.fstat(self.file.fileno()).st_size == 0:
+			return None
 
-		for msgid,msg in self.messagesByMessageID.items():
-			print "[MESSAGEID {}] from={} -> {}".format(msgid, msg[0].getMailFrom(), msg[0].message["instances"].keys())
+		if self.map is not None:
+			self.map.close()
+		self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
 
-	def connectAutomaticallyGeneratedMessages(self):
+		return self.map
+
+	def read(self, offset, length):
+
+		end = offset + length
+		if self.map is None or end > len(self.map):
+			# The log grew since it was mapped
+			if self.spool:
+				self.file.flush()
+			if self.map is not None:
+				self.map.close()
+			self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+		return self.map[offset:end]
+
+################################################################################
+# Rule matchers
+################################################################################
+
+class RuleMatcher():
+	"""
+	This class matches a line body against an ordered list of rules using
+	as few regular expression scans as possible.
+
+	All the rules are combined into a single alternation in which every
+	rule's body is wrapped into its own group. Alternatives are tried from
+	left to right, so the first matching rule wins exactly as it would
+	when the rules are tried one after the other, and lastindex of the
+	match tells which wrapper group, i.e. which rule, matched.
+
+	Python 2 limits a regular expression to 100 groups, so the rules are
+	split into several consecutive alternations when necessary.
+
+	Besides groups of the body, matchNamed gives a function that extracts
+	only the groups holding named fields of the matching rule from the
+	match (see groupExtractor). Regular expressions are compiled by the
+	given function, e.g. RuleCache.compile.
+	"""
+
+	MAX_GROUPS = 100
+
+	def __init__(self, rules, compile=re.compile):
+
+		self.rules = rules
+		self.compile = compile
+		self.chunks = []
+		self.namedChunks = []
+
+		chunk = []
+		ngroups = 0
+		for regex in rules:
+			groups = regex["groups"] + 1
+			if chunk and ngroups + groups > self.MAX_GROUPS:
+				self._addChunk(chunk)
+				chunk = []
+				ngroups = 0
+			chunk.append(regex)
+			ngroups += groups
+
+		if chunk:
+			self._addChunk(chunk)
+
+	def _addChunk(self, rules):
+
+		# There is no need for a wrapper group when there is a single rule
+		if len(rules) == 1:
+			regex = rules[0]
+			self.chunks.append((regex["pattern"], None, regex))
+			self.namedChunks.append((regex["pattern"], None, (regex, regex["values"])))
+			return
+
+		alternatives = []
+		wrappers = {}
+		named = {}
+		index = 1
+		for regex in rules:
+			alternatives.append("(" + regex["body"] + "$)")
+			wrappers[index] = (regex, index, index + regex["groups"])
+			named[index] = (regex, groupExtractor(tuple(index + group for group in regex["namedGroups"])))
+			index += regex["groups"] + 1
+
+		# Names of groups would repeat among the rules, so the bodies
+		# without names are combined
+		self.chunks.append((self.compile("|".join(alternatives)), wrappers, None))
+		self.namedChunks.append((self.chunks[-1][0], named, None))
+
+	def match(self, line, pos):
 		"""
-		The purpose of this method is to find messages that were generated
-		as a reaction to some existing message (like, deliver status
-		notifications) and that don't have the same message id.
+		Match line starting at pos. Returns the first matching rule, the
+		end of the match and the groups of the rule's body, or
+		(None, None, None) if no rule matches.
 		"""
 
-		if not hasattr(self, 'messagesByMessageID'):
-			self.consolidateMessagesByMessageID()
+		for cregex, wrappers, single in self.chunks:
+			res = cregex.match(line, pos)
+			if res:
+				if single is not None:
+					return single, res.end(), res.groups()
+				regex, first, last = wrappers[res.lastindex]
+				return regex, res.end(), res.groups()[first:last]
 
-		newQueueIDs = {}
-		for msgid,msgs in self.messagesByMessageID.items():
-			for msg in msgs:
-				newqueueid = msg.getNewQueueID()
-				if newqueueid != None:
-					newQueueIDs[msg.getQueueID()] = msgid
+		return None, None, None
 
-		self.topMessageIds = {}
-		for msgid,msgs in self.messagesByMessageID.items():
-			for msg in msgs:
-				if msg.getQueueID() in newQueueIDs.keys():
-					mid = newQueueIDs[msg.getQueueID()]
-					if not self.topMessageIds.has_key(mid):
-						self.topMessageIds[mid] = []
+	def matchNamed(self, data, pos, endpos):
+		"""
+		Match data between pos and endpos. Returns the first matching rule,
+		the match object and the function that extracts the values of the
+		named fields of the rule's body from it, or (None, None, None) if no
+		rule matches.
+		"""
 
-					self.topMessageIds[mid].append(msgs)
+		for cregex, named, single in self.namedChunks:
+			res = cregex.match(data, pos, endpos)
+			if res:
+				if single is not None:
+					return single[0], res, single[1]
+				regex, extract = named[res.lastindex]
+				return regex, res, extract
 
-					break
-			else:
-				self.topMessageIds[msgid] = [msgs]
+		return None, None, None
 
-	def dumpNonAutomaticallyGeneratedMessages(self):
+################################################################################
+# Fast path
+################################################################################
+
+class FastPathParser():
+	"""
+	This class parses the most frequent lines without trying all the rules
+	of their program. The short ones, qmgr "removed" and "from=<...>,
+	size=..." lines, smtpd "connect from" and "disconnect from" lines and
+	cleanup "message-id=" lines, are parsed without regular expressions:
+	their parts are found with str.find and str.split at the separators the
+	rules expect, and checked for the characters the rules allow.
+
+	smtp and lmtp "status=sent" lines have too many fields to be split
+	faster than by a regular expression. For them the rule that matches is
+	found by str.find, and then the rule's own regular expression is
+	matched alone, instead of an alternation of all the smtp rules.
+
+	A parser of a program gives the rule that would match the line, the
+	end of the whole match and the values of the named fields of the
+	body, exactly as the rule would extract them. Whenever a line doesn't
+	have precisely the expected shape, it gives None and the line is left
+	to the rules, so the fast path never takes a line the rules would
+	match differently. LogParserBenchmark.py --check-fast-path verifies
+	that on the test logs, of which tests/test4.log has every line shape
+	of the fast path, and on a generated log.
+	"""
+
+	QUEUEID_CHARS = "ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"
+	FQDN_CHARS = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789._-"
+
+	def __init__(self, rules):
+
+		byName = dict((regex["name"], regex) for regex in rules)
+		self.fromIdentified = byName["from_identified"]
+		self.messageRemoved = byName["message_removed"]
+		self.messageIDIdentified = byName["messageid_identified"]
+		self.clientConnect = byName["smtpd_client_connect"]
+		self.clientDisconnect = byName["smtpd_client_disconnect"]
+		self.messageQueued = byName["message_queued"]
+		self.messageQueuedAll = byName["message_queued_all"]
+		self.localDelivery = byName["local_delivery"]
+
+		# All the rules the fast path can give
+		self.rules = [self.fromIdentified, self.messageRemoved, self.messageIDIdentified, self.clientConnect,
+			self.clientDisconnect, self.messageQueued, self.messageQueuedAll, self.localDelivery]
+
+		# Parsers by program, every one is called with the line and the
+		# start of its body
+		self.parsers = {
+			"postfix/qmgr": self.qmgr,
+			"postfix/cleanup": self.cleanup,
+			"postfix/smtpd": self.smtpd,
+			"postfix/smtp": self.smtp,
+			"postfix/lmtp": self.lmtp,
+		}
+
+	def match(self, program, line, pos):
+		"""
+		Parse the body of a line from the program, starting at pos. Returns
+		the rule, the end of the match and the values of the named fields
+		of the body, or None if the line should be matched by the rules.
+		"""
+
+		parser = self.parsers.get(program)
+		if parser is None:
+			return None
 
-		for msgid,msg in self.topMessageIds.items():
-			print "[MESSAGEID {}] from={} -> {}]".format(msgid, msg[0].getMailFrom(), msg[0].message["instances"].keys())
+		return parser(line, pos)
 
-	def dumpLogWithQueueID(self, queueid):
+	def hostAndIP(self, value):
 		"""
-		The purpose of this method is to dump all log lines describing a
-		single Queue ID.
+		Split "host[IP]" into host and IP, or return None.
 		"""
 
-		if self.mailMessagesByQueueID.has_key(queueid):
-			msg = self.mailMessagesByQueueID[queueid]
-			print "[MESSAGEID {}] {} from={} -> {}".format(msg.getMessageID(), msg.getMailFrom(), msg.message["instances"].keys())
+		bracket = value.find("[")
+		if bracket < 1 or value[-1] != "]":
+			return None
+
+		host = value[:bracket]
+		ip = value[bracket + 1:-1]
+		if host.translate(None, self.FQDN_CHARS):
+			return None
 
+		if ip != "unknown":
+			parts = ip.split(".")
+			if len(parts) != 4 or "" in parts or len(max(parts, key=len)) > 3 or ip.translate(None, "0123456789."):
+				return None
+
+		return host, ip
+
+	# Rules end with $ (see RuleMatcher), which matches before the newline,
+	# so the whole match of a line ends at len(line) - (line[-1] == "\n")
+
+	def qmgr(self, line, pos):
+
+		colon = line.find(": ", pos, pos + 14)
+		queueid = line[pos:colon]
+		if colon < pos + 7 or queueid.translate(None, self.QUEUEID_CHARS):
+			return None
+
+		pos = colon + 2
+		end = len(line) - (line[-1] == "\n")
+		if end == pos + 7 and line.startswith("removed", pos):
+			return self.messageRemoved, end, (queueid,)
+
+		if not line.startswith("from=<", pos) or not line.endswith(" (queue active)", 0, end):
+			return None
+
+		parts = line[pos + 6:end - 15].split(">, size=")
+		if len(parts) != 2 or ">" in parts[0]:
+			return None
+		counts = parts[1].split(", nrcpt=")
+		if len(counts) != 2 or not counts[0].isdigit() or not counts[1].isdigit():
+			return None
+
+		return self.fromIdentified, end, (queueid, parts[0], counts[0], counts[1])
+
+	def cleanup(self, line, pos):
+
+		colon = line.find(": ", pos, pos + 14)
+		queueid = line[pos:colon]
+		if colon < pos + 7 or queueid.translate(None, self.QUEUEID_CHARS):
+			return None
+
+		pos = colon + 2
+		if line.startswith("message-id=", pos):
+			start = pos + 11
+		elif line.startswith("resent-message-id=", pos):
+			start = pos + 18
 		else:
-			for msgid,msgs in self.messagesByMessageID.items():
+			return None
 
-				for msg in msgs:
+		# The rule requires the newline
+		end = len(line)
+		if end - 1 <= start or line[-1] != "\n":
+			return None
 
-					if msg.getQueueID() != queueid:
-						continue
+		return self.messageIDIdentified, end, (queueid, line[start:end - 1])
 
-					print "[MESSAGEID {}][QUEUEID {}] from={} -> {}".format(msg.getMessageID(), msg.getQueueID(), msg.getMailFrom(), msg.message["instances"].keys())
-					return
+	def smtpd(self, line, pos):
 
-	def dumpAllQueueIDs(self):
+		if line.startswith("connect from ", pos):
+			regex = self.clientConnect
+			pos += 13
+		elif line.startswith("disconnect from ", pos):
+			regex = self.clientDisconnect
+			pos += 16
+		else:
+			return None
 
-		for msgid,msgs in self.messagesByMessageID.items():
-			for msg in msgs:
-				print "[MESSAGEID {}][QUEUEID {}] from={} -> {}".format(msg.getMessageID(), msg.getQueueID(), msg.getMailFrom(), msg.message["instances"].keys())
+		end = len(line) - (line[-1] == "\n")
+		client = self.hostAndIP(line[pos:end])
+		if client is None:
+			return None
 
-def main(filename):
-	mailLog = ZimbraMailLog()
+		return regex, end, client
 
-	if filename.endswith(".xz"):
-		import lzma
-		mailLog.parseLog(lzma.LZMAFile(filename))
-	elif filename.endswith(".gz"):
-		import gzip
-		mailLog.parseLog(gzip.open(filename))
-	else:
-		mailLog.parseLog(open(filename))
+	def matchRule(self, regex, line, pos):
+		"""
+		Match the body of a line by the pattern of the rule alone, and
+		extract only the values of its named fields.
+		"""
+
+		res = regex["pattern"].match(line, pos)
+		if res is None:
+			return None
+
+		return regex, res.end(), regex["values"](res)
+
+	def smtp(self, line, pos):
+
+		if line.find(", status=sent (", pos) == -1:
+			return None
+
+		# Discarded spam has its own rule before the others
+		if line.endswith(" - spam)", 0, len(line) - (line[-1] == "\n")):
+			return None
+
+		if line.find(" queued as ", pos) != -1:
+			fast = self.matchRule(self.messageQueued, line, pos)
+			if fast is not None:
+				return fast
+
+		return self.matchRule(self.messageQueuedAll, line, pos)
+
+	def lmtp(self, line, pos):
+
+		return self.matchRule(self.localDelivery, line, pos)
+
+################################################################################
+# Profiling
+################################################################################
+
+# State machine classes by the state machine identifier of rules. Records
+# of rules with smid "PID" aren't passed to any state machine.
+STATE_MACHINES = {
+	"POSTFIX": "PostfixProcess",
+	"DKIMMILTER": "DKIMMilterProcess",
+	"AMAVISD": "AmavisdProcess",
+	"queueid": "MailMessage",
+	"PID": "none",
+}
+
+class MatchProfile():
+	"""
+	This class collects the profile of parsing, see ZimbraMailLog with
+	profile set to True.
+
+	The rules a RuleMatcher combines into a single alternation are tried
+	one after the other instead, in the same order, so that for every rule
+	the number of match attempts, hits and the time spent in its regular
+	expression can be counted. The rank of the winning rule is its
+	position among the rules tried for the line, i.e. the number of failed
+	attempts before the hit. Besides that, time is measured for parsing
+	the line header, decoding the timestamp, extracting the fields into a
+	LogRecord and for every state machine class (including the bookkeeping
+	of ZimbraMailLog around it).
+
+	Timing every attempt makes parsing several times slower, so absolute
+	times are only meaningful relative to each other.
+	"""
+
+	def __init__(self, rules):
+		self.rules = rules
+		self.compiled = [regex["pattern"] for regex in rules]
+
+		# Per rule id
+		self.attempts = [0] * len(rules)
+		self.hits = [0] * len(rules)
+		self.times = [0.0] * len(rules)
+		self.ranks = [0] * len(rules)
+
+		self.lines = 0
+		self.unmatched = 0
+		self.stages = {"header": 0.0, "match": 0.0, "timestamp": 0.0, "extraction": 0.0}
+		self.stateMachines = dict((name, [0, 0.0]) for name in STATE_MACHINES.itervalues())
+
+	def match(self, matcher, line, pos):
+		"""
+		Match line starting at pos against the rules of a RuleMatcher,
+		with the same result as RuleMatcher.match.
+		"""
+
+		for rank, regex in enumerate(matcher.rules):
+			ruleid = regex["id"]
+			start = time.time()
+			res = self.compiled[ruleid].match(line, pos)
+			self.times[ruleid] += time.time() - start
+			self.attempts[ruleid] += 1
+			if res:
+				self.hits[ruleid] += 1
+				self.ranks[ruleid] += rank
+				return regex, res.end(), res.groups()
+
+		self.unmatched += 1
+		return None, None, None
+
+	def report(self):
+		"""
+		Return the profile as a dictionary, suitable for JSON. Rules are
+		sorted by the time spent in them.
+		"""
+
+		rules = []
+		for regex in self.rules:
+			ruleid = regex["id"]
+			rules.append({
+				"id": ruleid,
+				"name": regex["name"],
+				"program": regex["program"],
+				"attempts": self.attempts[ruleid],
+				"hits": self.hits[ruleid],
+				"time": self.times[ruleid],
+				"averageRank": float(self.ranks[ruleid]) / self.hits[ruleid] if self.hits[ruleid] else None,
+			})
+		rules.sort(key=lambda rule: rule["time"], reverse=True)
+
+		attempts = sum(self.attempts)
+		return {
+			"lines": self.lines,
+			"unmatched": self.unmatched,
+			"attemptsPerLine": float(attempts) / self.lines if self.lines else 0.0,
+			"failedAttemptsPerLine": float(attempts - sum(self.hits)) / self.lines if self.lines else 0.0,
+			"stages": dict(self.stages),
+			"stateMachines": dict((name, {"records": records, "time": elapsed}) for name, (records, elapsed) in self.stateMachines.iteritems()),
+			"rules": rules,
+		}
+
+	def save(self, filename):
+		"""
+		Write the profile into a JSON file.
+		"""
+
+		with open(filename, "w") as out:
+			json.dump(self.report(), out, indent=1, sort_keys=True)
+
+	def table(self, output=sys.stderr):
+		"""
+		Print the profile as tables sorted by time.
+		"""
+
+		report = self.report()
+
+		print >>output, "{} lines, {:.2f} match attempts per line, {:.2f} failed".format(report["lines"], report["attemptsPerLine"], report["failedAttemptsPerLine"])
+		print >>output
+		print >>output, "{:<12} {:>10}".format("stage", "time [s]")
+		for stage, elapsed in sorted(report["stages"].iteritems(), key=lambda item: item[1], reverse=True):
+			print >>output, "{:<12} {:>10.3f}".format(stage, elapsed)
+		print >>output
+		print >>output, "{:<20} {:>10} {:>10}".format("state machine", "records", "time [s]")
+		for name, counters in sorted(report["stateMachines"].iteritems(), key=lambda item: item[1]["time"], reverse=True):
+			print >>output, "{:<20} {:>10} {:>10.3f}".format(name, counters["records"], counters["time"])
+		print >>output
+		print >>output, "{:<40} {:>10} {:>10} {:>10} {:>8}".format("rule", "attempts", "hits", "time [s]", "rank")
+		for rule in report["rules"]:
+			rank = "{:.2f}".format(rule["averageRank"]) if rule["averageRank"] is not None else "-"
+			print >>output, "{:<40} {:>10} {:>10} {:>10.3f} {:>8}".format(rule["name"], rule["attempts"], rule["hits"], rule["time"], rank)
+
+################################################################################
+# Queue ID genealogy
+################################################################################
+
+class QueueIDGenealogy():
+	"""
+	This class keeps track of messages created from other messages, i.e.
+	a message reinjected after content filtering gets a new queue ID, and
+	so do relayed messages and delivery status notifications. Together,
+	they form a DAG from the originating message to all its descendants.
+
+	Every message is a node, numbered from 0, and nodes of the same flow
+	are joined in a union-find structure whose roots know the originating
+	node. So, finding the origin of a node takes amortized constant time,
+	and building all the flows takes linear time.
+
+	Queue IDs are reused by postfix, so a queue ID refers to the node of
+	the last message that had it.
+	"""
+
+	def __init__(self):
+		# Per node: queue ID, parent in the DAG, union-find parent, size
+		# of the set (valid for roots), origin of the set (valid for roots)
+		self.queueids = []
+		self.parents = []
+		self.sets = []
+		self.sizes = []
+		self.origins = []
+
+		# Per node message, if messages are kept
+		self.messages = []
+
+		# The last node for every queue ID
+		self.nodes = {}
+
+	def __len__(self):
+		return len(self.queueids)
+
+	def addNode(self, queueid, msg=None):
+		node = len(self.queueids)
+		self.queueids.append(queueid)
+		self.parents.append(None)
+		self.sets.append(node)
+		self.sizes.append(1)
+		self.origins.append(node)
+		self.messages.append(msg)
+		self.nodes[queueid] = node
+		return node
+
+	def find(self, node):
+		sets = self.sets
+		while sets[node] != node:
+			# Path halving
+			sets[node] = sets[sets[node]]
+			node = sets[node]
+
+		return node
+
+	def link(self, parent, child):
+		"""
+		Note that child was created from parent.
+		"""
+
+		if self.parents[child] is not None or parent == child:
+			return
+		self.parents[child] = parent
+
+		parentRoot = self.find(parent)
+		childRoot = self.find(child)
+		if parentRoot == childRoot:
+			return
+
+		origin = self.origins[parentRoot]
+		if self.sizes[parentRoot] < self.sizes[childRoot]:
+			parentRoot, childRoot = childRoot, parentRoot
+		self.sets[childRoot] = parentRoot
+		self.sizes[parentRoot] += self.sizes[childRoot]
+		self.origins[parentRoot] = origin
+
+	def origin(self, node):
+		return self.origins[self.find(node)]
+
+	def chain(self, node):
+		"""
+		Return nodes from the origin to the given node.
+		"""
+
+		chain = [node]
+		while self.parents[node] is not None:
+			node = self.parents[node]
+			chain.append(node)
+
+		chain.reverse()
+		return chain
+
+	def flows(self):
+		"""
+		Return a dictionary with a list of nodes for every origin.
+		"""
+
+		flows = {}
+		for node in xrange(len(self.queueids)):
+			flows.setdefault(self.origin(node), []).append(node)
+
+		return flows
+
+################################################################################
+# Main classes
+################################################################################
+
+class ZimbraMailLog():
+
+	# Every LATENCY_SAMPLE-th line is timed for metrics
+	LATENCY_SAMPLE = 16
+
+	def __init__(self, epochTimestamps=False, keepLines=True, retainProcessed=True,
+			expireAfter=None, multiHost=False, profile=False, quarantine=None, fastPath=True,
+			ruleCache=None, delays=None, events=None, genealogy=None):
+
+		# Regular expressions are compiled through a RuleCache, which keeps
+		# them in the directory ruleCache if it is given
+		self.ruleCache = ruleCache
+		cache = RuleCache(ruleCache, zimbra8)
+
+		self.regex = zimbra8
+		self.header = cache.compile(header_re)
+
+		# The same without "^", which matches only at the beginning of data
+		# and not at pos, for matching lines within a buffer
+		self.bufferHeader = cache.compile(header_re[1:])
+
+		# Rules are tried only for the program given in the line header,
+		# in the same order as they are defined in zimbra8
+		self.rulesByProgram = compileRules(zimbra8, cache.compile)
+
+		# For every program there is a matcher for each first word of the
+		# body some rule starts with, holding the rules starting with that
+		# word and the rules that can start with anything. The latter ones
+		# alone are used for any other line. When no rule has a literal
+		# first word, there is no need to look at the body at all.
+		self.matchers = {}
+		for program, rules in self.rulesByProgram.items():
+			keys = set(regex["key"] for regex in rules if regex["key"] is not None)
+			keyed = dict((key, RuleMatcher([regex for regex in rules if regex["key"] in (None, key)], cache.compile)) for key in keys)
+			self.matchers[program] = (keyed or None, RuleMatcher([regex for regex in rules if regex["key"] is None], cache.compile))
+		cache.save()
+
+		# The most frequent lines are parsed without regular expressions,
+		# unless fastPath is False (see FastPathParser)
+		self.fastPath = None
+		self.fastParsers = {}
+		if fastPath:
+			self.fastPath = FastPathParser(zimbra8)
+			self.fastParsers = self.fastPath.parsers
+
+		# For generators of mail messages
+		self.stateProcessPID = {}
+
+		# All the messages with assigned queueid currently being processed
+		self.mailMessagesByQueueID = {}
+
+		# All the processed messages. If retainProcessed is False, messages
+		# are only passed to the caller of iterMessages and then forgotten
+		self.retainProcessed = retainProcessed
+		self.processedMessages = []
+
+		# Messages done or expired since the last line, to be yielded by
+		# iterMessages
+		self.retiredMessages = []
+
+		# Decoder of the timestamps. If epochTimestamps is True, timestamps
+		# are kept as integers instead of datetime objects
+		self.timestamps = TimestampDecoder(epoch=epochTimestamps)
+
+		# If keepLines is False, log records keep only offsets of the lines
+		# within log files, and lines are read back when needed
+		self.keepLines = keepLines
+
+		# When expireAfter is given, processes and messages that didn't
+		# log anything for that many seconds of log time are removed. The
+		# log time of the last record of every PID and queue ID is kept in
+		# lastSeen, and the heap holds (time, kind, key) entries ordered by
+		# time. Heap entries older than lastSeen are stale and skipped.
+		self.expireAfter = expireAfter
+		self.lastSeen = {}
+		self.expiryHeap = []
+		self.lastExpiry = None
+
+		# Expired messages and counters of expired processes and messages
+		self.expiredMessages = []
+		self.expiredCounters = {"processes": 0, "messages": 0}
+
+		# When logs of several hosts are parsed together (see mergeLogs),
+		# processes and messages are kept by (hostname, PID) and
+		# (hostname, queue ID), since those are unique only on one host
+		self.multiHost = multiHost
+
+		# Messages created from other messages, see QueueIDGenealogy. In
+		# multiHost mode, hostnames are collected to find the host of a
+		# relayed message. The genealogy has a node for every message, so
+		# unless genealogy is True, it is kept only when processed messages
+		# are retained.
+		if genealogy is None:
+			genealogy = retainProcessed
+		self.genealogy = QueueIDGenealogy() if genealogy else None
+		self.pendingNodes = {}
+		self.hostnames = set()
+
+		# Messages that were in flight when the next file of a rotation
+		# set was started, and the number of them that were then processed
+		# (see startNextFile)
+		self.carriedMessages = set()
+		self.recoveredMessages = 0
+
+		# When profile is True, lines are parsed and processed through
+		# profiledParseLine and profiledProcessLogRecord, which collect
+		# the profile (see MatchProfile)
+		self.profile = None
+		if profile:
+			self.profile = MatchProfile(zimbra8)
+
+		# Counters for metrics (see ParserMetrics), completedStates counts
+		# recipients of retired messages by their final state, and every
+		# LATENCY_SAMPLE-th line is timed into lineLatency
+		self.linesParsed = 0
+		self.bytesRead = 0
+		self.unmatchedLines = 0
+		self.completedStates = {}
+		self.lineLatency = LatencyHistogram()
+		self.violations = 0
+
+		# If a LogQuarantine is given, parsing is tolerant: lines no rule
+		# matches and lines a state machine rejects are quarantined instead
+		# of raising an exception
+		self.quarantine = quarantine
+
+		# If a DelayAnalytics is given, delays of deliveries of every done
+		# message are added to it
+		self.delays = delays
+
+		# If an EventTable is given, every log record is added to it
+		self.events = events
+
+	def matchFields(self, line, decode=None):
+		"""
+		Find the rule that matches a log line, trying the fast path first.
+		Returns the matching rule and the values of its fields, i.e. of a
+		LogRecord, or (None, None) if no rule matches. If decode is given,
+		it is called to convert the timestamp.
+		"""
+
+		hdr = self.header.match(line)
+		if hdr is None:
+			return None, None
+
+		regex, end, values = self.matchBody(line, hdr)
+		if regex is None:
+			return None, None
+
+		if decode is None:
+			return regex, (line[:end],) + hdr.group(1, 2, 4) + values
+		return regex, (line[:end], decode(hdr.group(1))) + hdr.group(2, 4) + values
+
+	def matchBody(self, line, hdr):
+		"""
+		Find the rule that matches the body of a log line, given the match
+		of its header, trying the fast path first. Returns the matching
+		rule, the end of the match and the values of the named fields of the
+		body, or (None, None, None) if no rule matches.
+		"""
+
+		parser = self.fastParsers.get(hdr.group(3))
+		if parser is not None:
+			fast = parser(line, hdr.end())
+			if fast is not None:
+				return fast
+
+		return self.matchRules(line, hdr)
+
+	def matchRules(self, line, hdr):
+		"""
+		The same as matchBody, but without the fast path. Only the rules
+		for the program from the header are tried, and only the named
+		fields are extracted from the match (see RuleMatcher.matchNamed).
+		"""
+
+		matchers = self.matchers.get(hdr.group(3))
+		if matchers is None:
+			return None, None, None
+
+		keyed, matcher = matchers
+		bodyStart = hdr.end()
+		if keyed is not None:
+			wordEnd = line.find(" ", bodyStart)
+			if wordEnd != -1:
+				matcher = keyed.get(line[bodyStart:wordEnd], matcher)
+
+		regex, res, extract = matcher.matchNamed(line, bodyStart, len(line))
+		if regex is None:
+			return None, None, None
+
+		return regex, res.end(), extract(res)
+
+	def matchLine(self, line, decode=None, hdr=None):
+		"""
+		Find the first rule that matches a log line. The header of the line
+		is parsed only once, and then only the rules for the program from
+		the header are tried.
+
+		Returns the matching rule and a tuple with the groups the complete
+		rule's regular expression would have, i.e. the whole match,
+		timestamp, hostname, PID and then the groups from the body. If
+		decode is given, it is called to convert the timestamp. If no rule
+		matches, (None, None) is returned. The match of the header can be
+		given if the caller has it already.
+		"""
+
+		if hdr is None:
+			hdr = self.header.match(line)
+			if hdr is None:
+				return None, None
+
+		matchers = self.matchers.get(hdr.group(3))
+		if matchers is None:
+			return None, None
+
+		keyed, matcher = matchers
+		bodyStart = hdr.end()
+		if keyed is not None:
+			wordEnd = line.find(" ", bodyStart)
+			if wordEnd != -1:
+				matcher = keyed.get(line[bodyStart:wordEnd], matcher)
+
+		regex, end, groups = matcher.match(line, bodyStart)
+		if regex is None:
+			return None, None
+
+		if decode is None:
+			return regex, (line[:end],) + hdr.group(1, 2, 4) + groups
+
+		return regex, (line[:end], decode(hdr.group(1))) + hdr.group(2, 4) + groups
+
+	def parseLine(self, line, logFile=None, offset=0):
+		"""
+		Parse a single log line into a LogRecord with fields named by the
+		matching rule. Returns None if there is no rule for the line.
+
+		If logFile is given, the returned record doesn't keep the line
+		itself but refers to it by the offset within the log file.
+		"""
+
+		hdr = self.header.match(line)
+		if hdr is None:
+			return None
+
+		# The same as matchBody, with the fast path inlined
+		parser = self.fastParsers.get(hdr.group(3))
+		fast = None
+		if parser is not None:
+			fast = parser(line, hdr.end())
+		if fast is not None:
+			regex, end, values = fast
+		else:
+			regex, end, values = self.matchRules(line, hdr)
+			if regex is None:
+				return None
+
+		if regex.get("print"):
+			print regex["name"]
+			print line[:end]
+			print hdr.group(1, 2, 4) + values
+			print
+			sys.exit(1)
+
+		if logFile is not None:
+			return LineRefLogRecord(regex["id"], (None, self.timestamps.decode(hdr.group(1))) + hdr.group(2, 4) + values, logFile, offset, end)
+
+		return LogRecord(regex["id"], (line[:end], self.timestamps.decode(hdr.group(1))) + hdr.group(2, 4) + values)
+
+	def profiledParseLine(self, line, logFile=None, offset=0):
+		"""
+		The same as parseLine, but the time of every stage is added to the
+		profile, and rules are tried one by one (see MatchProfile). The
+		fast path isn't used, so that the profile covers all the rules.
+		"""
+
+		profile = self.profile
+		stages = profile.stages
+		profile.lines += 1
+
+		start = time.time()
+		hdr = self.header.match(line)
+		matchers = self.matchers.get(hdr.group(3)) if hdr is not None else None
+		stages["header"] += time.time() - start
+		if matchers is None:
+			profile.unmatched += 1
+			return None
+
+		start = time.time()
+		keyed, matcher = matchers
+		bodyStart = hdr.end()
+		if keyed is not None:
+			wordEnd = line.find(" ", bodyStart)
+			if wordEnd != -1:
+				matcher = keyed.get(line[bodyStart:wordEnd], matcher)
+		regex, end, groups = profile.match(matcher, line, bodyStart)
+		stages["match"] += time.time() - start
+		if regex is None:
+			return None
+
+		start = time.time()
+		timestamp = self.timestamps.decode(hdr.group(1))
+		stages["timestamp"] += time.time() - start
+
+		start = time.time()
+		groups = (line[:end], timestamp) + hdr.group(2, 4) + groups
+		if logFile is not None:
+			record = LineRefLogRecord(regex["id"], (None,) + regex["extract"](groups)[1:], logFile, offset, len(groups[0]))
+		else:
+			record = LogRecord(regex["id"], regex["extract"](groups))
+		stages["extraction"] += time.time() - start
+
+		return record
+
+	def profiledProcessLogRecord(self, parsed_message):
+		"""
+		The same as processLogRecord, but the time is added to the profile
+		of the state machine class the record belongs to.
+		"""
+
+		start = time.time()
+		self.processLogRecord(parsed_message)
+		counters = self.profile.stateMachines[STATE_MACHINES[parsed_message["regex"]["smid"]]]
+		counters[0] += 1
+		counters[1] += time.time() - start
+
+	def iterMessages(self, fileLikeObject, reference=None, workers=None):
+		"""
+		Parse all the lines from a file like object, and yield every
+		message as soon as it is done, i.e. as soon as it is moved to
+		processed messages, or expired (see expire). The reference is a
+		datetime used to determine the year of the first timestamp, e.g.
+		modification time of the log file. When not given, the current
+		time is used.
+
+		If workers is given, lines are classified by that many worker
+		processes (see classifyParallel), while state machines still get
+		the records in the original order. Profiling is done only without
+		workers.
+		"""
+
+		if workers and self.profile is not None:
+			raise InternalLogParserException("Profiling doesn't work with workers")
+
+		if reference is not None:
+			self.timestamps.reference = reference
+
+		logFile = None
+		offset = 0
+		if not self.keepLines:
+			logFile = LogFile(fileLikeObject)
+
+		# Lines come with the results of classifyLines from workers, or
+		# they are parsed here, and then both are processed the same way
+		if workers:
+			lines = itertools.chain.from_iterable(itertools.izip(chunk, results) for chunk, results in self.classifyParallel(fileLikeObject, workers))
+			classifiedLogRecord = self.classifiedLogRecord
+			def parse(line, result, logFile, offset):
+				if result is None:
+					return None
+				return classifiedLogRecord(result, line, logFile, offset)
+		else:
+			lines = itertools.izip(fileLikeObject, itertools.repeat(None))
+			parseLine = self.parseLine
+			if self.profile is not None:
+				parseLine = self.profiledParseLine
+			def parse(line, result, logFile, offset):
+				return parseLine(line, logFile, offset)
+
+		processLogRecord = self.processLogRecord
+		if self.profile is not None:
+			processLogRecord = self.profiledProcessLogRecord
+
+		# To count line number
+		lineCounter = 0
+
+		for line, result in lines:
+			lineCounter += 1
+			if lineCounter % 10000 == 0: print >>sys.stderr, lineCounter
+			self.linesParsed += 1
+			self.bytesRead += len(line)
+			sample = lineCounter % self.LATENCY_SAMPLE == 0
+			if sample: start = time.time()
+
+			if logFile is not None:
+				offset = logFile.append(line)
+
+			self.processParsedRecord(processLogRecord, parse(line, result, logFile, offset), line, lineCounter)
+			if sample: self.lineLatency.observe(time.time() - start)
+
+			if self.retiredMessages:
+				for msg in self.retiredMessages:
+					yield msg
+				del self.retiredMessages[:]
+
+	def processParsedRecord(self, processLogRecord, parsed_message, line, lineNumber):
+		"""
+		Process a log record parsed from a line with processLogRecord. If
+		the line didn't match any rule, i.e. parsed_message is None, it is
+		counted and quarantined, or UnexpectedEventLogParserException is
+		raised without a quarantine.
+		"""
+
+		if parsed_message is None:
+			self.unmatchedLines += 1
+			if self.quarantine is None:
+				raise UnexpectedEventLogParserException("LINE({}): {}".format(lineNumber, line))
+			self.quarantine.add(LogQuarantine.UNMATCHED, line, lineNumber)
+		elif self.quarantine is None:
+			processLogRecord(parsed_message)
+		else:
+			self.processQuarantined(processLogRecord, parsed_message, line, lineNumber)
+
+	def processQuarantined(self, processLogRecord, parsed_message, line, lineNumber):
+		"""
+		Process a log record with processLogRecord, and quarantine the
+		line if a state machine rejects it, i.e. raises LogParserException,
+		or KeyError when it looks up a field the record doesn't have. The
+		state machine stays in the state it was in when it raised, which is
+		usually the state before the line. Other exceptions are errors in
+		the parser, so they are passed on.
+		"""
+
+		try:
+			processLogRecord(parsed_message)
+		except (LogParserException, KeyError) as e:
+			self.violations += 1
+			self.quarantine.add(e.__class__.__name__, line, lineNumber)
+
+	def parseLog(self, fileLikeObject, reference=None, workers=None):
+		"""
+		Parse all the lines from a file like object. See iterMessages for
+		the description of arguments.
+		"""
+
+		for msg in self.iterMessages(fileLikeObject, reference, workers):
+			pass
+
+	def iterBufferedMessages(self, fileLikeObject, reference=None, blockSize=1024*1024):
+		"""
+		The same as iterMessages, but lines are not read one by one. A
+		plain log file is memory mapped, and anything else, e.g. a
+		BackgroundReader decompressing a log, is read in large blocks. Rules
+		are matched directly within the map or the block (see iterBuffer),
+		so the records always refer to their lines by offsets, as when
+		keepLines is False.
+		"""
+
+		if self.profile is not None:
+			raise InternalLogParserException("Profiling doesn't work with buffered parsing")
+
+		if reference is not None:
+			self.timestamps.reference = reference
+
+		if type(fileLikeObject) is file and os.path.isfile(fileLikeObject.name):
+			logFile = LogFile(fileLikeObject)
+			data = logFile.mapAll()
+			if data is not None:
+				for msg in self.iterBuffer(data, logFile.offset, len(data), logFile, 0):
+					yield msg
+			return
+
+		if isinstance(fileLikeObject, BackgroundReader):
+			blocks = fileLikeObject.blocks()
+		else:
+			blocks = iter(lambda: fileLikeObject.read(blockSize), "")
+
+		# Blocks are spooled, so records can read their lines back, and
+		# the partial line at the end of a block is parsed with the next one
+		logFile = LogFile(None)
+		tail = ""
+		for block in blocks:
+			base = logFile.append(block) - len(tail)
+			if tail:
+				block = tail + block
+			end = block.rfind("\n") + 1
+			for msg in self.iterBuffer(block, 0, end, logFile, base):
+				yield msg
+			tail = block[end:]
+
+		if tail:
+			for msg in self.iterBuffer(tail, 0, len(tail), logFile, logFile.offset - len(tail)):
+				yield msg
+
+	def iterBuffer(self, data, pos, end, logFile, base):
+		"""
+		Parse the lines of data, a string or a memory map, from pos to end,
+		and yield messages as soon as they are done. Data starts at offset
+		base of logFile.
+
+		No string is made of a line. The header and the rules are matched
+		within data using pos and endpos, only groups of named fields are
+		extracted from the match, and LineRefLogRecord refers to the line
+		by its offset.
+		"""
+
+		header = self.bufferHeader.match
+		matchers = self.matchers
+		decode = self.timestamps.decode
+		processLogRecord = self.processLogRecord
+		find = data.find
+
+		while pos < end:
+			# Rules match the newline too
+			eol = find("\n", pos, end)
+			if eol == -1:
+				eol = end
+			else:
+				eol += 1
+
+			self.linesParsed += 1
+			if self.linesParsed % 10000 == 0: print >>sys.stderr, self.linesParsed
+			self.bytesRead += eol - pos
+			sample = self.linesParsed % self.LATENCY_SAMPLE == 0
+			if sample: start = time.time()
+
+			record = None
+			hdr = header(data, pos, eol)
+			if hdr is not None:
+				programMatchers = matchers.get(hdr.group(3))
+				if programMatchers is not None:
+					keyed, matcher = programMatchers
+					bodyStart = hdr.end()
+					if keyed is not None:
+						wordEnd = find(" ", bodyStart, eol)
+						if wordEnd != -1:
+							matcher = keyed.get(data[bodyStart:wordEnd], matcher)
+
+					regex, res, extract = matcher.matchNamed(data, bodyStart, eol)
+					if regex is not None:
+						record = LineRefLogRecord(regex["id"], (None, decode(hdr.group(1))) + hdr.group(2, 4) + extract(res), logFile, base + pos, res.end() - pos)
+
+			# The line is made only when it is needed for an error
+			if record is not None and self.quarantine is None:
+				processLogRecord(record)
+			else:
+				self.processParsedRecord(processLogRecord, record, data[pos:eol], self.linesParsed)
+			if sample: self.lineLatency.observe(time.time() - start)
+
+			pos = eol
+
+			if self.retiredMessages:
+				for msg in self.retiredMessages:
+					yield msg
+				del self.retiredMessages[:]
+
+	def classifyParallel(self, fileLikeObject, workers, chunkLines=10000):
+		"""
+		Classify lines from a file like object in a pool of worker
+		processes. Lines are sent to workers in chunks, and for every chunk,
+		in the original order, the lines and the results of classifyLines
+		are yielded. At most two chunks per worker are in flight, so the
+		memory use doesn't depend on the size of the log.
+		"""
+
+		# The same iterator has to be used for all the chunks, otherwise
+		# e.g. a generator would be started again for every chunk
+		fileLikeObject = iter(fileLikeObject)
+
+		pool = multiprocessing.Pool(workers, initClassifierWorker, (self.ruleCache,))
+		try:
+			pending = collections.deque()
+			while True:
+				lines = list(itertools.islice(fileLikeObject, chunkLines))
+				if lines:
+					pending.append((lines, pool.apply_async(classifyLines, (lines,))))
+
+				if pending and (not lines or len(pending) > 2 * workers):
+					lines, result = pending.popleft()
+					yield lines, result.get()
+
+				elif not lines:
+					break
+		finally:
+			pool.terminate()
+
+	def classifiedLogRecord(self, result, line, logFile=None, offset=0):
+		"""
+		Create a LogRecord from the result of classifyLines for a line. The
+		timestamp is decoded here, since the year depends on the previous
+		lines. See parseLine for the description of logFile and offset.
+		"""
+
+		ruleid, length, timestamp, values = result
+		if logFile is not None:
+			return LineRefLogRecord(ruleid, (None, self.timestamps.decode(timestamp)) + values, logFile, offset, length)
+
+		return LogRecord(ruleid, (line[:length], self.timestamps.decode(timestamp)) + values)
+
+	# Attributes that hold the state of unfinished processes and
+	# messages, see getState
+	stateAttributes = ("stateProcessPID", "mailMessagesByQueueID", "timestamps",
+		"lastSeen", "expiryHeap", "lastExpiry", "expiredCounters")
+
+	def getState(self):
+		"""
+		Return the state of unfinished processes and messages as a
+		dictionary that can be pickled, and later restored with setState
+		to continue parsing where it stopped. Processed and expired
+		messages are not part of the state.
+		"""
+
+		if not self.keepLines:
+			raise InternalLogParserException("State can't be saved when only offsets of lines are kept")
+
+		return dict((name, getattr(self, name)) for name in self.stateAttributes)
+
+	def setState(self, state):
+		"""
+		Restore the state saved with getState.
+		"""
+
+		for name in self.stateAttributes:
+			setattr(self, name, state[name])
+
+		# Genealogy isn't saved, so nodes of messages are not valid
+		for msg in self.mailMessagesByQueueID.itervalues():
+			msg.node = None
+
+	def retireMessage(self, msg, expired=False):
+		"""
+		Move message to processed messages, or to expired messages if it
+		expired, unless they are not retained. Either way, the message is
+		accounted for in metrics, delays and the genealogy.
+		"""
+
+		if expired:
+			msg.expired = True
+			self.expiredCounters["messages"] += 1
+			if self.retainProcessed:
+				self.expiredMessages.append(msg)
+		elif self.retainProcessed:
+			self.processedMessages.append(msg)
+		self.retiredMessages.append(msg)
+
+		if msg in self.carriedMessages:
+			self.carriedMessages.discard(msg)
+			if not expired:
+				self.recoveredMessages += 1
+
+		for msginstance in msg.message["instances"].itervalues():
+			self.completedStates[msginstance.state] = self.completedStates.get(msginstance.state, 0) + 1
+
+		if self.delays is not None:
+			self.delays.addMessage(msg)
+
+		if self.genealogy is None:
+			return
+
+		node = self.messageNode(msg)
+		for queueid, relayhostname in msg.getChildQueueIDs():
+			key = self.childQueueKey(msg, queueid, relayhostname)
+			if key is not None:
+				self.genealogy.link(node, self.queueIDNode(key))
+
+	def queueKey(self, hostname, queueid):
+		"""
+		Return the key of a queue ID in mailMessagesByQueueID.
+		"""
+
+		if self.multiHost:
+			return (hostname, queueid)
+
+		return queueid
+
+	def messageQueueKey(self, msg):
+		if self.multiHost:
+			return (msg.getHostname(), msg.getQueueID())
+
+		return msg.getQueueID()
+
+	def childQueueKey(self, msg, queueid, relayhostname):
+		"""
+		Return the key of a message created from msg, or None if it was
+		relayed to a host whose log isn't parsed. Delivery status
+		notifications and messages reinjected by content filters are on
+		the same host.
+		"""
+
+		if relayhostname is None or relayhostname in ("127.0.0.1", "::1", "localhost"):
+			if self.multiHost:
+				return (msg.getHostname(), queueid)
+			return queueid
+
+		if relayhostname in self.hostnames:
+			return self.queueKey(relayhostname, queueid)
+		elif relayhostname.split(".")[0] in self.hostnames:
+			return self.queueKey(relayhostname.split(".")[0], queueid)
+
+		return None
+
+	def messageNode(self, msg):
+		"""
+		Return the genealogy node of a message, adding it when needed. If
+		a message created from another one was referred to before it was
+		seen, the node added then is used.
+		"""
+
+		if msg.node is None:
+			key = self.messageQueueKey(msg)
+			msg.node = self.pendingNodes.pop(key, None)
+			if msg.node is None:
+				msg.node = self.genealogy.addNode(key)
+
+		if self.retainProcessed:
+			self.genealogy.messages[msg.node] = msg
+
+		return msg.node
+
+	def queueIDNode(self, key):
+		"""
+		Return the genealogy node of the message with the given queue key,
+		which is either in flight, or was the last one processed with it.
+		Otherwise, the message wasn't seen yet, and a node is added for it.
+		"""
+
+		msg = self.mailMessagesByQueueID.get(key)
+		if msg is not None:
+			return self.messageNode(msg)
+
+		node = self.genealogy.nodes.get(key)
+		if node is None:
+			node = self.genealogy.addNode(key)
+			self.pendingNodes[key] = node
+
+		return node
+
+	def originOf(self, queueid, hostname=None):
+		"""
+		Return the queue ID of the message from which the last message with
+		the given queue ID originates, or None if it isn't known.
+		"""
+
+		if self.genealogy is None:
+			return None
+
+		node = self.genealogy.nodes.get(self.queueKey(hostname, queueid))
+		if node is None:
+			return None
+
+		return self.genealogy.queueids[self.genealogy.origin(node)]
+
+	def hopChain(self, queueid, hostname=None):
+		"""
+		Return queue IDs from the originating message to the last message
+		with the given queue ID.
+		"""
+
+		if self.genealogy is None:
+			return []
+
+		node = self.genealogy.nodes.get(self.queueKey(hostname, queueid))
+		if node is None:
+			return []
+
+		return [self.genealogy.queueids[n] for n in self.genealogy.chain(node)]
+
+	def startNextFile(self):
+		"""
+		Note that the following lines come from the next file of a
+		rotation set. Messages in flight are remembered, and those that
+		are processed later are counted in recoveredMessages, since
+		parsing the file on its own would skip them.
+		"""
+
+		self.carriedMessages.update(self.mailMessagesByQueueID.itervalues())
+
+	def touch(self, kind, key, now):
+		"""
+		Note that PID or queue ID was seen at the given log time.
+		"""
+
+		if self.lastSeen.get((kind, key)) != now:
+			self.lastSeen[(kind, key)] = now
+			heapq.heappush(self.expiryHeap, (now, kind, key))
+
+	def expire(self, now):
+		"""
+		Remove processes and messages that weren't seen for expireAfter
+		seconds before the given log time. Expired messages are marked as
+		such, and passed on like processed messages.
+		"""
+
+		horizon = now - self.expireAfter
+		heap = self.expiryHeap
+		while heap and heap[0][0] < horizon:
+			seen, kind, key = heapq.heappop(heap)
+			if self.lastSeen.get((kind, key)) != seen:
+				continue
+			del self.lastSeen[(kind, key)]
+
+			if kind == "PID":
+				if self.stateProcessPID.pop(key, None) is not None:
+					self.expiredCounters["processes"] += 1
+
+			else:
+				msg = self.mailMessagesByQueueID.pop(key, None)
+				if msg is not None:
+					self.retireMessage(msg, expired=True)
+
+	def processLogRecord(self, parsed_message):
+		"""
+		Pass a parsed log record to the state machine it belongs to.
+		"""
+
+		regex = parsed_message["regex"]
+
+		if self.events is not None:
+			self.events.add(parsed_message)
+
+		pid = parsed_message["PID"]
+		queueid = parsed_message.get("queueid")
+		if self.multiHost:
+			hostname = parsed_message["hostname"]
+			self.hostnames.add(hostname)
+			pid = (hostname, pid)
+			if queueid is not None:
+				queueid = (hostname, queueid)
+
+		if self.expireAfter is not None:
+			now = self.timestamps.lastEpoch
+			if now != self.lastExpiry:
+				self.expire(now)
+				self.lastExpiry = now
+
+			if regex["smid"] in ("POSTFIX", "DKIMMILTER", "AMAVISD"):
+				self.touch("PID", pid, now)
+			if queueid is not None:
+				self.touch("queueid", queueid, now)
+
+		if regex["smid"] == "POSTFIX":
+
+			if not self.stateProcessPID.has_key(pid):
+				self.stateProcessPID[pid] = PostfixProcess(pid)
+			cmd, arg = self.stateProcessPID[pid].process(parsed_message)
+
+			if cmd == CMD_MSGADD:
+				self.mailMessagesByQueueID[queueid] = arg
+			elif cmd == CMD_MSGERR:
+				if self.multiHost:
+					arg = (hostname, arg)
+				msg = self.mailMessagesByQueueID.get(arg)
+				if msg is None:
+					raise UnexpectedEventLogParserException("Error for unknown queue ID {}: {}".format(arg, parsed_message["all"]))
+				msg.process(parsed_message)
+				self.retireMessage(msg)
+				del self.mailMessagesByQueueID[arg]
+			elif cmd == CMD_PIDDEL:
+				del self.stateProcessPID[pid]
+			elif cmd is not None:
+				raise UnexpectedEventLogParserException("Unhandled command: {}".format(cmd))
+
+		elif regex["smid"] == "DKIMMILTER":
+
+			if not self.stateProcessPID.has_key(pid):
+				self.stateProcessPID[pid] = DKIMMilterProcess(pid)
+
+			cmd, arg = self.stateProcessPID[pid].process(parsed_message)
+
+			if cmd == CMD_MSGADD:
+				self.mailMessagesByQueueID[queueid] = arg
+			elif cmd == CMD_PIDDEL:
+				del self.stateProcessPID[pid]
+			elif cmd is not None:
+				raise UnexpectedEventLogParserException("Unhandled command: {}".format(cmd))
+
+		elif regex["smid"] == "AMAVISD":
+
+			if not self.stateProcessPID.has_key(pid):
+				self.stateProcessPID[pid] = AmavisdProcess(pid)
+			cmd, arg = self.stateProcessPID[pid].process(parsed_message)
+
+			if cmd == CMD_MSGADD:
+				self.mailMessagesByQueueID[queueid] = arg
+			elif cmd == CMD_PIDDEL:
+				del self.stateProcessPID[pid]
+			elif cmd is not None:
+				raise UnexpectedEventLogParserException("Unhandled command: {}".format(cmd))
+
+		elif regex["smid"] == "queueid":
+
+			if not self.mailMessagesByQueueID.has_key(queueid):
+
+				if regex["name"] == "messageid_identified":
+					# It can happen than postfix/cleanup generates a new message in
+					# response to some error. So, we handle that case here by
+					# creating a new mail message object.
+					self.mailMessagesByQueueID[queueid] = MailMessage(INTERNAL, parsed_message["queueid"])
+
+				elif regex["name"] == "pickup":
+					# This handles localy generated mail messages
+					#
+					# Note that we don't pass queueid to constructor since we'll call
+					# process method a bit later!
+					self.mailMessagesByQueueID[queueid] = MailMessage(LOCAL)
+
+				else:
+					# This point is reached for messages that arrived before the
+					# current log was started. Those messages we ignore for now,
+					# but maybe we should collect them too.
+					return
+					raise UnexpectedEventLogParserException("Unhandled queueid: {}".format(queueid))
+
+			elif regex["name"] == "messageid_identified":
+
+				# It happens that previous message "dissapeared" and then a new one
+				# appears, with different messageid, and being a different message.
+				# So to take into account that case, we first check that message id
+				# is different (safegard), then we "retire" the old message, and we
+				# instatiate a new message.
+				oldmsgid = self.mailMessagesByQueueID[queueid].getMessageID()
+				if oldmsgid != "" and oldmsgid != parsed_message["messageid"]:
+					self.retireMessage(self.mailMessagesByQueueID[queueid])
+					self.mailMessagesByQueueID[queueid] = MailMessage(INTERNAL, parsed_message["queueid"])
+
+			cmd, arg = self.mailMessagesByQueueID[queueid].process(parsed_message)
+
+			if cmd == CMD_MSGDONE:
+				self.retireMessage(self.mailMessagesByQueueID[queueid])
+				del self.mailMessagesByQueueID[queueid]
+
+			elif cmd is not None:
+				raise UnexpectedEventLogParserException("Unhandled command: {}".format(cmd))
+
+	def dumpProcessedMessages(self):
+
+		for msg in self.processedMessages:
+			print "[QUEUEID {}] messageid={} newqueueid={}".format(msg.getQueueID(), msg.getMessageID(), msg.getNewQueueIDs())
+
+	def dumpUnprocessedMessages(self):
+
+		for queueid, msg in self.mailMessagesByQueueID.items():
+			print "[QUEUEID {}] messageid={}".format(queueid, msg.getMessageID())
+
+	def dumpNewQueueIDs(self):
+
+		for msg in self.processedMessages:
+			print "[MESSAGEID {}] newqueueids={}".format(msg.getMessageID(), [queueid for queueid, relayhostname in msg.getChildQueueIDs()])
+
+	def consolidateMessagesByMessageID(self):
+		"""
+		The purpose of this method is to generate a list of messages that
+		are originating ones, i.e. they came from the outside of the
+		system. The consolidation is done using message ID as it is the
+		most reliable way to determine messages.
+		"""
+
+		self.messagesByMessageID = {}
+		for msg in self.processedMessages:
+
+			msgid = msg.getMessageID()
+			if not self.messagesByMessageID.has_key(msgid):
+				self.messagesByMessageID[msgid] = []
+
+			self.messagesByMessageID[msgid].append(msg)
+
+	def dumpMessagesByMessageID(self):
+
+		for msgid,msg in self.messagesByMessageID.items():
+			print "[MESSAGEID {}] from={} -> {}".format(msgid, msg[0].getMailFrom(), msg[0].message["instances"].keys())
+
+	def connectAutomaticallyGeneratedMessages(self):
+		"""
+		The purpose of this method is to find messages that were generated
+		as a reaction to some existing message (like, deliver status
+		notifications) and that don't have the same message id. Groups of
+		messages with the same message id are collected in topMessageIds
+		under the message id of the originating message, as found in the
+		queue ID genealogy.
+		"""
+
+		if not hasattr(self, 'messagesByMessageID'):
+			self.consolidateMessagesByMessageID()
+
+		self.topMessageIds = {}
+		for msgid,msgs in self.messagesByMessageID.items():
+			mid = msgid
+			if msgs[0].node is not None:
+				origin = self.genealogy.messages[self.genealogy.origin(msgs[0].node)]
+				if origin is not None:
+					mid = origin.getMessageID()
+
+			if not self.topMessageIds.has_key(mid):
+				self.topMessageIds[mid] = []
+
+			self.topMessageIds[mid].append(msgs)
+
+	def dumpNonAutomaticallyGeneratedMessages(self):
+
+		for msgid,msgs in self.topMessageIds.items():
+			print "[MESSAGEID {}] from={} -> {}".format(msgid, msgs[0][0].getMailFrom(), msgs[0][0].message["instances"].keys())
+
+	def dumpLogWithQueueID(self, queueid, hostname=None):
+		"""
+		The purpose of this method is to dump all log lines describing a
+		single Queue ID. In multiHost mode, the hostname of the message
+		can be given, otherwise the first message with the queue ID on
+		any host is dumped.
+		"""
+
+		msg = self.mailMessagesByQueueID.get(self.queueKey(hostname, queueid))
+		if msg is None and self.multiHost and hostname is None:
+			for key, inflight in self.mailMessagesByQueueID.iteritems():
+				if key[1] == queueid:
+					msg = inflight
+					break
+
+		if msg is not None:
+			print "[MESSAGEID {}][QUEUEID {}] from={} -> {}".format(msg.getMessageID(), msg.getQueueID(), msg.getMailFrom(), msg.message["instances"].keys())
+			self.dumpLogRecords(msg)
+
+		else:
+			for msgid,msgs in self.messagesByMessageID.items():
+
+				for msg in msgs:
+
+					if msg.getQueueID() != queueid:
+						continue
+					if hostname is not None and self.multiHost and msg.getHostname() != hostname:
+						continue
+
+					print "[MESSAGEID {}][QUEUEID {}] from={} -> {}".format(msg.getMessageID(), msg.getQueueID(), msg.getMailFrom(), msg.message["instances"].keys())
+					self.dumpLogRecords(msg)
+					return
+
+	def dumpLogRecords(self, msg):
+
+		for logRecord in msg.message["logRecords"]:
+			print "\t" + logRecord["all"].rstrip("\n")
+
+	def dumpAllQueueIDs(self):
+
+		for msgid,msgs in self.messagesByMessageID.items():
+			for msg in msgs:
+				print "[MESSAGEID {}][QUEUEID {}] from={} -> {}".format(msg.getMessageID(), msg.getQueueID(), msg.getMailFrom(), msg.message["instances"].keys())
+
+################################################################################
+# Parallel classification
+################################################################################
+
+# ZimbraMailLog object used to classify lines in a worker process
+workerMailLog = None
+
+def initClassifierWorker(ruleCache=None):
+	global workerMailLog
+	workerMailLog = ZimbraMailLog(ruleCache=ruleCache)
+
+def classifyLines(lines):
+	"""
+	Classify lines in a worker process. For every line the result is None
+	if no rule matches, or the rule ID, the length of the matched line, the
+	timestamp as it is in the log and the values of the remaining fields.
+	"""
+
+	result = []
+	for line in lines:
+		regex, values = workerMailLog.matchFields(line)
+		if regex is None:
+			result.append(None)
+		else:
+			result.append((regex["id"], len(values[0]), values[1], values[2:]))
+
+	return result
+
+################################################################################
+# Input
+################################################################################
+
+class BackgroundReader():
+	"""
+	Read blocks from a file like object in a background thread, e.g. to
+	decompress a log while it is being parsed, and iterate over lines of
+	those blocks. Blocks are passed through a bounded queue, so the reader
+	can get at most queueSize blocks ahead of the parser.
+
+	Both stages record how long they were blocked waiting for the other
+	one. If the parser was blocked most of the time, reading limits the
+	throughput, and the other way around.
+
+	The reader is its own iterator, like a file, so lines can be taken
+	from it in several steps, e.g. by itertools.islice. Lines of the
+	current block and the partial line at its end are kept between them.
+	"""
+
+	def __init__(self, fileLikeObject, blockSize=1024*1024, queueSize=8):
+		self.fileLikeObject = fileLikeObject
+		self.blockSize = blockSize
+		self.queue = Queue.Queue(queueSize)
+		self.stopped = False
+
+		# Iterator over lines of the current block, the partial line at
+		# the end of the block, and whether the last block was read
+		self.lines = iter(())
+		self.tail = ""
+		self.finished = False
+
+		# Seconds spent waiting for a free slot in the queue, and
+		# waiting for a block
+		self.readerBlocked = 0.0
+		self.parserBlocked = 0.0
+
+		self.thread = threading.Thread(target=self.readBlocks, name="BackgroundReader")
+		self.thread.daemon = True
+		self.thread.start()
+
+	def readBlocks(self):
+		try:
+			while not self.stopped:
+				block = self.fileLikeObject.read(self.blockSize)
+				self.putBlock(block)
+				if not block:
+					break
+
+		except Exception:
+			self.putBlock(sys.exc_info())
+
+	def putBlock(self, block):
+		start = time.time()
+		self.queue.put(block)
+		self.readerBlocked += time.time() - start
+
+	def getBlock(self):
+		start = time.time()
+		block = self.queue.get()
+		self.parserBlocked += time.time() - start
+
+		if type(block) is tuple:
+			raise block[0], block[1], block[2]
+
+		return block
+
+	def blocks(self):
+		"""
+		Yield blocks as they were read, without splitting them into lines.
+		"""
+
+		while True:
+			block = self.getBlock()
+			if not block:
+				break
+			yield block
+
+	def __iter__(self):
+		return self
+
+	def next(self):
+		line = next(self.lines, None)
+		if line is not None:
+			return line
+
+		while not self.finished:
+			block = self.getBlock()
+			if not block:
+				self.finished = True
+				lines = [self.tail] if self.tail else []
+				self.tail = ""
+			else:
+				lines = block.split("\n")
+				lines[0] = self.tail + lines[0]
+				self.tail = lines.pop()
+				lines = [line + "\n" for line in lines]
+
+			if lines:
+				self.lines = iter(lines)
+				return next(self.lines)
+
+		raise StopIteration
+
+	def close(self):
+		"""
+		Stop the background thread, and close the file like object.
+		"""
+
+		self.stopped = True
+		while self.thread.is_alive():
+			try:
+				self.queue.get(timeout=0.1)
+			except Queue.Empty:
+				pass
+
+		self.fileLikeObject.close()
+
+	def stats(self):
+		return "reader blocked {:.2f} s, parser blocked {:.2f} s".format(self.readerBlocked, self.parserBlocked)
+
+class LogFollower():
+	"""
+	Follow a log file that is being written to, like tail -F, and
+	iterate over its lines forever. The file is polled every interval
+	seconds when there are no new lines.
+
+	When the file name points to a different inode, the log was rotated.
+	Lines written to the old file after it was last read are read to its
+	end, and then the new one is opened and read from the beginning.
+	When the file gets shorter than the position it was read to, it was
+	truncated and is read again from the beginning. Lines are passed on
+	only when they are complete.
+	"""
+
+	def __init__(self, filename, interval=0.2):
+		self.filename = filename
+		self.interval = interval
+		self.rotations = 0
+		self.truncations = 0
+
+	def __iter__(self):
+		logFile = open(self.filename)
+		inode = os.fstat(logFile.fileno()).st_ino
+		partial = ""
+
+		while True:
+			line = logFile.readline()
+			if line:
+				if line.endswith("\n"):
+					yield partial + line
+					partial = ""
+				else:
+					partial += line
+				continue
+
+			try:
+				stat = os.stat(self.filename)
+			except OSError:
+				# Rotated, and the new file wasn't created yet
+				stat = None
+
+			if stat is not None and stat.st_ino != inode:
+				# The old file may still have been written to after the
+				# last readline, so it is read to the end first
+				for line in iter(logFile.readline, ""):
+					if line.endswith("\n"):
+						yield partial + line
+						partial = ""
+					else:
+						partial += line
+				if partial:
+					yield partial + "\n"
+				logFile.close()
+				logFile = open(self.filename)
+				inode = os.fstat(logFile.fileno()).st_ino
+				partial = ""
+				self.rotations += 1
+				continue
+
+			if stat is not None and stat.st_size < logFile.tell():
+				logFile.seek(0)
+				partial = ""
+				self.truncations += 1
+				continue
+
+			time.sleep(self.interval)
+
+class LagMeter():
+	"""
+	Measure the lag between the log time of lines and the time they are
+	processed by a ZimbraMailLog. Lines are passed through lines(), and
+	when the next line is requested, the previous one was processed, so
+	the lag is the current time minus the log time of the last record.
+	Log time is local time, and its resolution is one second.
+
+	Statistics are written to output every interval seconds.
+	"""
+
+	def __init__(self, mailLog, interval=60, output=sys.stderr):
+		self.mailLog = mailLog
+		self.interval = interval
+		self.output = output
+		self.second = None
+		self.now = None
+		self.lastReport = time.time()
+		self.reset()
+
+	def reset(self):
+		self.count = 0
+		self.total = 0
+		self.max = None
+		self.last = None
+
+	def lines(self, lines):
+		for line in lines:
+			yield line
+			self.record()
+
+	def record(self):
+		logTime = self.mailLog.timestamps.lastEpoch
+		if logTime is None:
+			return
+
+		second = int(time.time())
+		if second != self.second:
+			# Current local time, in the same form as lastEpoch
+			self.second = second
+			self.now = calendar.timegm(time.localtime(second))
+
+			if second - self.lastReport >= self.interval:
+				self.report()
+				self.lastReport = second
+
+		lag = self.now - logTime
+		self.count += 1
+		self.total += lag
+		self.last = lag
+		if self.max is None or lag > self.max:
+			self.max = lag
+
+	def report(self):
+		if self.count:
+			print >>self.output, "Lag: last {} s, average {:.1f} s, max {} s over {} lines".format(self.last, float(self.total) / self.count, self.max, self.count)
+			self.output.flush()
+		self.reset()
+
+class LogCheckpoint():
+	"""
+	Checkpoint of a log file that is parsed repeatedly while it grows,
+	e.g. the live maillog from cron. The state of ZimbraMailLog is saved
+	together with the inode, the first line and the offset up to which
+	the log was parsed, so the next run continues from that offset.
+
+	If the log was rotated, truncated or replaced in the meantime, or if
+	rules changed, the checkpoint is ignored and the log is parsed from
+	the beginning. The reason is left in status.
+	"""
+
+	def __init__(self, filename):
+		self.filename = filename
+		self.offset = 0
+		self.status = None
+
+	def rulesDigest(self):
+		return hashlib.md5("\n".join(rule["regex"] for rule in zimbra8)).hexdigest()
+
+	def load(self):
+		try:
+			with open(self.filename, "rb") as f:
+				return cPickle.load(f)
+		except IOError:
+			return None
+
+	def open(self, mailLog, logFilename):
+		"""
+		Open the log file and restore the state of mailLog from the
+		checkpoint if it is still valid for the log. Returns an iterator
+		over the lines that follow the checkpoint.
+		"""
+
+		logFile = open(logFilename)
+		stat = os.fstat(logFile.fileno())
+		self.inode = stat.st_ino
+		self.firstLine = logFile.readline()
+		self.offset = 0
+
+		saved = self.load()
+		if saved is None:
+			self.status = "no checkpoint"
+		elif saved["rules"] != self.rulesDigest():
+			self.status = "rules changed"
+		elif saved["inode"] != self.inode:
+			self.status = "log rotated"
+		elif saved["offset"] > stat.st_size:
+			self.status = "log truncated"
+		elif saved["firstLine"] != self.firstLine:
+			self.status = "log replaced"
+		else:
+			self.status = "resumed at offset {}".format(saved["offset"])
+			self.offset = saved["offset"]
+			mailLog.setState(saved["state"])
+
+		logFile.seek(self.offset)
+		return self.lines(logFile)
+
+	def lines(self, logFile):
+		for line in logFile:
+			if not line.endswith("\n"):
+				# The line is still being written, so it is left
+				# for the next run
+				break
+
+			self.offset += len(line)
+			yield line
+
+	def save(self, mailLog):
+		"""
+		Save the state of mailLog and the offset up to which the log was
+		parsed. The checkpoint is replaced atomically.
+		"""
+
+		saved = {
+			"rules": self.rulesDigest(),
+			"inode": self.inode,
+			"firstLine": self.firstLine,
+			"offset": self.offset,
+			"state": mailLog.getState(),
+		}
+
+		f = tempfile.NamedTemporaryFile(dir=os.path.dirname(os.path.abspath(self.filename)), delete=False)
+		try:
+			cPickle.dump(saved, f, cPickle.HIGHEST_PROTOCOL)
+			f.close()
+			os.rename(f.name, self.filename)
+		except:
+			f.close()
+			os.unlink(f.name)
+			raise
+
+def rotationKey(filename):
+	"""
+	Sort key that orders files of a rotation set from the oldest to the
+	newest. Rotated files have either a date (maillog-20130922.xz) or a
+	number (maillog.2.gz, higher is older) appended, and the active log
+	comes last.
+	"""
+
+	number = re.match(r"^.*?(?:[.-](\d+))?(?:\.xz|\.gz)?$", os.path.basename(filename)).group(1)
+	if number is None:
+		return (1, 0, "")
+	elif len(number) >= 8:
+		return (0, 0, number)
+	else:
+		return (0, -int(number), "")
+
+def rotationSet(pattern):
+	"""
+	Return the files of a rotation set in chronological order. The
+	pattern is a glob, or a directory in which case maillog files in it
+	are used.
+	"""
+
+	if os.path.isdir(pattern):
+		pattern = os.path.join(pattern, "maillog*")
+
+	return sorted(glob.glob(pattern), key=rotationKey)
+
+def iterRotationSet(mailLog, filenames):
+	"""
+	Iterate over lines of all the given files, decompressing them as
+	needed, and tell mailLog, unless it is None, when the next file
+	starts. Lines should be processed as they are read, so this doesn't
+	work with workers.
+	"""
+
+	for i, filename in enumerate(filenames):
+		if i > 0 and mailLog is not None:
+			mailLog.startNextFile()
+
+		logFile = openLog(filename)
+		try:
+			for line in logFile:
+				yield line
+		finally:
+			logFile.close()
+
+def mergeLogs(sources, references):
+	"""
+	Merge lines from several logs, e.g. from different hosts, into one
+	stream ordered by timestamps. Sources are iterables over lines, each
+	of them ordered by itself, and references are datetimes used to
+	determine the year of their first timestamps (see TimestampDecoder).
+	Lines with the same timestamp are taken from the sources in the given
+	order. Lines without a valid timestamp get the timestamp of the line
+	before them in their source, so they are passed on in place and
+	reported when they are parsed. Only one line per source is kept in
+	memory.
+	"""
+
+	def timestamped(index, lines, decoder):
+		timestamp = 0
+		for line in lines:
+			# Syslog timestamp, e.g. "Sep 22 03:59:16", has a fixed width
+			try:
+				timestamp = decoder.decode(line[:15])
+			except (KeyError, ValueError):
+				pass
+			yield timestamp, index, line
+
+	streams = []
+	for index, (lines, reference) in enumerate(zip(sources, references)):
+		streams.append(timestamped(index, lines, TimestampDecoder(reference, epoch=True)))
+
+	for timestamp, index, line in heapq.merge(*streams):
+		yield line
+
+def openLog(filename, background=True):
+	"""
+	Open a plain, xz or gzip compressed log file. Compressed files are
+	decompressed in a background thread (see BackgroundReader), unless
+	background is False.
+	"""
+
+	if filename.endswith(".xz"):
+		import lzma
+		fileLikeObject = lzma.LZMAFile(filename)
+	elif filename.endswith(".gz"):
+		import gzip
+		fileLikeObject = gzip.open(filename)
+	else:
+		return open(filename)
+
+	if background:
+		return BackgroundReader(fileLikeObject)
+
+	return fileLikeObject
+
+################################################################################
+# Pre-filter
+################################################################################
+
+class LineFilter():
+	"""
+	This class skips lines before they are classified, using only
+	substring checks on the raw line, which is much cheaper than matching
+	rules.
+
+	Drop classes are lines that never affect reconstruction of messages,
+	i.e. lines of rules with smid "PID" and of programs like anvil.
+	Every class is a list of (program, prefix, substrings) checks, and a
+	line is in the class if its program token is program, its body starts
+	with prefix and contains all the substrings. Dropped lines are counted
+	per class.
+
+	In targeted mode only lines related to the given needles, i.e. queue
+	IDs, addresses or client IPs, are kept. First, discover() finds the
+	queue IDs of messages whose lines contain a needle, together with the
+	messages they were created from and the messages created from them.
+	Then lines with those queue IDs are kept, and so are smtpd sessions in
+	which such a message was received or a line contains a needle, from
+	connect to disconnect, so the process state machines see complete
+	sessions. Lines of a session are held back until it is known whether
+	the session is relevant.
+
+	Held sessions are bounded like the state of the parser. A session is
+	forgotten when its PID connects again, or when it didn't log anything
+	for SESSION_EXPIRY seconds of log time, e.g. because smtpd was killed
+	or the log ends in the middle of it. A session with more than
+	MAX_HELD_LINES lines is passed on as if it was relevant.
+	"""
+
+	DROP_CLASSES = {
+		"anvil": [("postfix/anvil", "", ())],
+		"scache": [("postfix/scache", "", ())],
+		"spawn": [("postfix/spawn", "", ()), ("spawn", "", ())],
+		"tls": [("postfix/smtpd", prefix + " TLS connection established from ", ()) for prefix in ("Anonymous", "Untrusted", "Trusted", "Verified")] +
+			[("postfix/smtp", prefix + " TLS connection established to ", ()) for prefix in ("Anonymous", "Untrusted", "Trusted", "Verified")] +
+			[("postfix/smtpd", "warning: TLS library problem: ", ()), ("postfix/smtpd", "SSL_accept error from ", ())],
+		"sasl_failure": [("postfix/smtpd", "warning: ", ("authentication fail",))],
+		"dns_warning": [("postfix/smtpd", "warning: hostname ", ())],
+		"hostname_warning": [("postfix/smtpd", "warning: numeric hostname: ", ()), ("postfix/smtp", "warning: valid_hostname: ", ()), ("postfix/smtp", "warning: malformed domain name ", ())],
+		"milter_warning": [("postfix/smtpd", "warning: milter ", ()), ("postfix/cleanup", "warning: milter ", ())],
+		"connect_error": [("postfix/smtp", "connect to ", ())],
+	}
+
+	SESSION_PROGRAMS = ("postfix/smtpd", "postfix/amavisd/smtpd", "postfix/dkimmilter/smtpd")
+
+	# Held sessions are checked for expiry every SESSION_SWEEP seconds of
+	# log time
+	SESSION_EXPIRY = 3600
+	SESSION_SWEEP = 60
+	MAX_HELD_LINES = 1000
+
+	child = re.compile(r"(?:queued as |notification: )([A-Z0-9]{7,12})\b")
+
+	# The same queue IDs the rules accept, including ones of digits only
+	queueid = re.compile(queueid_re + "$")
+
+	def __init__(self, drop=(), needles=None):
+
+		# For every program, the prefixes of all its checks, so most lines
+		# are passed after a single startswith(), and the checks
+		self.checks = {}
+		self.dropped = {}
+		for name in drop:
+			if name not in self.DROP_CLASSES:
+				raise InternalLogParserException("Unknown drop class {}".format(name))
+			for program, prefix, substrings in self.DROP_CLASSES[name]:
+				prefixes, checks = self.checks.setdefault(program, ((), []))
+				self.checks[program] = (prefixes + (prefix,), checks + [(name, prefix, substrings)])
+			self.dropped[name] = 0
+
+		self.needles = None
+		self.queueids = None
+		self.passes = 0
+		self.expiredSessions = 0
+		if needles:
+			self.needles = re.compile("|".join(re.escape(needle) for needle in needles))
+			self.dropped["untargeted"] = 0
+
+	def split(self, line):
+		"""
+		Return the program, the session key (hostname, program and PID) and
+		the start of the body of a line. The timestamp has a fixed width.
+		"""
+
+		start = line.find(" ", 16) + 1
+		end = line.find("[", start)
+		bodyStart = line.find("]: ", end) + 3
+		return line[start:end], line[16:bodyStart], bodyStart
+
+	def queueIDOf(self, line, bodyStart):
+		queueid = line[bodyStart:line.find(":", bodyStart)]
+		if self.queueid.match(queueid) and queueid != "NOQUEUE":
+			return queueid
+		return None
+
+	def childOf(self, line, bodyStart):
+		if "queued as " in line or "notification: " in line:
+			res = self.child.search(line, bodyStart)
+			if res:
+				return res.group(1)
+		return None
+
+	def discover(self, openLines):
+		"""
+		Find queue IDs of the targeted messages. openLines is called to get
+		the lines for every pass. A message found by a line that mentions
+		a message created from it might itself be created from a message
+		seen earlier, so the lines are read again until no such message is
+		found.
+		"""
+
+		queueids = set()
+		search = self.needles.search
+		while True:
+			self.passes += 1
+			backward = False
+			for line in openLines():
+				bodyStart = line.find("]: ", 16) + 3
+				queueid = self.queueIDOf(line, bodyStart)
+				if queueid is None:
+					continue
+
+				if queueid in queueids or search(line, bodyStart):
+					queueids.add(queueid)
+					child = self.childOf(line, bodyStart)
+					if child is not None:
+						queueids.add(child)
+				else:
+					child = self.childOf(line, bodyStart)
+					if child is not None and child in queueids:
+						queueids.add(queueid)
+						backward = True
+
+			if not backward:
+				break
+
+		self.queueids = queueids
+
+	def lines(self, lines):
+		"""
+		Yield the lines that are not dropped.
+		"""
+
+		if self.queueids is None:
+			return self.droppedLines(lines)
+		return self.targetedLines(lines)
+
+	def drop(self, line, start):
+		"""
+		Return True if the line is in a drop class, start is the start of
+		the program token.
+		"""
+
+		checks = self.checks.get(line[start:line.find("[", start)])
+		if checks is None:
+			return False
+
+		prefixes, checks = checks
+		bodyStart = line.find("]: ", start) + 3
+		if not line.startswith(prefixes, bodyStart):
+			return False
+
+		for name, prefix, substrings in checks:
+			if line.startswith(prefix, bodyStart):
+				for substring in substrings:
+					if line.find(substring, bodyStart) == -1:
+						break
+				else:
+					self.dropped[name] += 1
+					return True
+
+		return False
+
+	def droppedLines(self, lines):
+		drop = self.drop
+		for line in lines:
+			if not drop(line, line.find(" ", 16) + 1):
+				yield line
+
+	def targetedLines(self, lines):
+		queueids = self.queueids
+		decode = TimestampDecoder(epoch=True).decode
+
+		# Held lines, or True for a relevant session, and the log time of
+		# the last line of every session
+		sessions = {}
+		lastSeen = {}
+		stamp = None
+		now = None
+		lastSweep = None
+
+		for line in lines:
+			if self.checks and self.drop(line, line.find(" ", 16) + 1):
+				continue
+
+			program, session, bodyStart = self.split(line)
+
+			queueid = self.queueIDOf(line, bodyStart)
+
+			if program in self.SESSION_PROGRAMS:
+				if line[:15] != stamp:
+					stamp = line[:15]
+					try:
+						now = decode(stamp)
+					except (KeyError, ValueError):
+						pass
+					if lastSweep is None:
+						lastSweep = now
+					elif now is not None and now - lastSweep >= self.SESSION_SWEEP:
+						self.expireSessions(sessions, lastSeen, now - self.SESSION_EXPIRY)
+						lastSweep = now
+
+				if line.startswith("connect from ", bodyStart):
+					# The PID was reused, so the old session is over
+					self.forgetSession(sessions, session)
+					sessions[session] = [line]
+					lastSeen[session] = now
+					continue
+
+				held = sessions.get(session)
+				if held is not None:
+					lastSeen[session] = now
+
+				if held is True:
+					yield line
+				elif queueid in queueids or self.needles.search(line, bodyStart):
+					if held:
+						for heldLine in held:
+							yield heldLine
+					yield line
+					sessions[session] = True
+					lastSeen[session] = now
+				elif held is not None:
+					held.append(line)
+					if len(held) > self.MAX_HELD_LINES:
+						for heldLine in held:
+							yield heldLine
+						sessions[session] = True
+				else:
+					self.dropped["untargeted"] += 1
+
+				if line.startswith("disconnect from ", bodyStart):
+					self.forgetSession(sessions, session)
+					lastSeen.pop(session, None)
+
+			elif queueid in queueids:
+				yield line
+			else:
+				self.dropped["untargeted"] += 1
+
+	def forgetSession(self, sessions, session):
+		"""
+		Remove a session, counting its held lines as dropped.
+		"""
+
+		held = sessions.pop(session, None)
+		if held is not None and held is not True:
+			self.dropped["untargeted"] += len(held)
+
+	def expireSessions(self, sessions, lastSeen, before):
+		"""
+		Forget sessions whose last line was logged before the given time.
+		"""
+
+		for session, seen in lastSeen.items():
+			if seen < before:
+				del lastSeen[session]
+				self.forgetSession(sessions, session)
+				self.expiredSessions += 1
+
+	def report(self):
+		report = ", ".join("{} {}".format(name, count) for name, count in sorted(self.dropped.iteritems()))
+		if self.expiredSessions:
+			report += " ({} sessions expired)".format(self.expiredSessions)
+		return report
+
+################################################################################
+# Quarantine
+################################################################################
+
+class LogQuarantine():
+	"""
+	This class collects lines that a tolerant ZimbraMailLog couldn't use:
+	lines no rule matches, and lines a state machine rejected by raising
+	an exception. Such lines are written unchanged into the quarantine
+	file, if one is given, so the file is a log again and can be parsed
+	once rules are fixed.
+
+	Lines are also grouped into templates, in which IP addresses, queue
+	IDs and numbers of the line's body are masked, and the summary of the
+	templates with their counts is written to the file with ".summary"
+	appended to its name.
+	"""
+
+	UNMATCHED = "unmatched"
+
+	mask = re.compile(r"(?P<IP>\b[0-9]{1,3}(?:\.[0-9]{1,3}){3}\b)|(?P<QUEUEID>\b(?=[A-Z]*[0-9])(?=[0-9]*[A-Z])[A-Z0-9]{7,12}\b)|(?P<N>[0-9]+)")
+	header = re.compile(header_re)
+
+	def __init__(self, filename=None):
+		self.filename = filename
+		self.output = None
+		if filename is not None:
+			self.output = open(filename, "w")
+
+		# For every (kind, template) a list with count, line number and
+		# the first line
+		self.templates = {}
+		self.count = 0
+
+	def template(self, line):
+		"""
+		Return the template of a line, i.e. program and the body of the
+		line with variable parts masked.
+		"""
+
+		line = line.rstrip("\n")
+		hdr = self.header.match(line)
+		if hdr is not None:
+			line = hdr.group(3) + ": " + line[hdr.end():]
+
+		return self.mask.sub(lambda res: "<" + res.lastgroup + ">", line)
+
+	def add(self, kind, line, lineNumber):
+		"""
+		Quarantine a line. Kind is UNMATCHED or the name of the exception a
+		state machine raised.
+		"""
+
+		self.count += 1
+		if self.output is not None:
+			self.output.write(line if line.endswith("\n") else line + "\n")
+
+		key = (kind, self.template(line))
+		entry = self.templates.get(key)
+		if entry is None:
+			self.templates[key] = [1, lineNumber, line.rstrip("\n")]
+		else:
+			entry[0] += 1
+
+	def summary(self):
+		"""
+		Return the templates as (count, kind, template, line number, first
+		line) tuples, the most frequent first.
+		"""
+
+		return sorted(((count, kind, template, lineNumber, line) for (kind, template), (count, lineNumber, line) in self.templates.iteritems()), reverse=True)
+
+	def close(self, output=sys.stderr, top=10):
+		"""
+		Close the quarantine file and write the summary next to it. The
+		top templates are also printed to output.
+		"""
+
+		summary = self.summary()
+
+		if self.output is not None:
+			self.output.close()
+			with open(self.filename + ".summary", "w") as out:
+				for count, kind, template, lineNumber, line in summary:
+					print >>out, "{:>10} {} {}".format(count, kind, template)
+					print >>out, "{:>10} line {}: {}".format("", lineNumber, line)
+
+		if self.count:
+			print >>output, "Quarantined {} lines in {} templates".format(self.count, len(summary))
+			for count, kind, template, lineNumber, line in summary[:top]:
+				print >>output, "{:>10} {} {}".format(count, kind, template)
+
+################################################################################
+# Delay analytics
+################################################################################
+
+class DelaySketch():
+	"""
+	This class keeps quantiles of delays in bounded memory. Delays are
+	counted in buckets with logarithmic bounds, bucket i holding delays in
+	(GAMMA ** (i - 1), GAMMA ** i], so any quantile is known within a
+	relative error of ACCURACY, whatever the range of delays. Delays below
+	MINIMUM, which postfix logs as 0, are counted separately, and from
+	MINIMUM to a year there are about 1200 buckets.
+	"""
+
+	ACCURACY = 0.01
+	GAMMA = (1 + ACCURACY) / (1 - ACCURACY)
+	MINIMUM = 0.001
+
+	def __init__(self):
+		self.buckets = {}
+		self.zero = 0
+		self.count = 0
+		self.sum = 0.0
+		self.max = 0.0
+
+	@classmethod
+	def bucket(cls, value):
+		"""
+		Return the index of the bucket of a delay, or None if it is below
+		MINIMUM.
+		"""
+
+		if value < cls.MINIMUM:
+			return None
+
+		return int(math.ceil(math.log(value) / math.log(cls.GAMMA)))
+
+	def add(self, value):
+		index = self.bucket(value)
+
+		self.count += 1
+		self.sum += value
+		if value > self.max:
+			self.max = value
+
+		if index is None:
+			self.zero += 1
+		else:
+			self.buckets[index] = self.buckets.get(index, 0) + 1
+
+	def quantile(self, q):
+		"""
+		Return the delay at quantile q (0 to 1), or None if no delay was
+		added.
+		"""
+
+		if not self.count:
+			return None
+
+		rank = q * (self.count - 1)
+		seen = self.zero
+		if rank < seen:
+			return 0.0
+
+		for index in sorted(self.buckets):
+			seen += self.buckets[index]
+			if rank < seen:
+				# The middle of the bucket by relative error
+				return min(2 * self.GAMMA ** index / (self.GAMMA + 1), self.max)
+
+		return self.max
+
+	def merge(self, other):
+		for index, count in other.buckets.iteritems():
+			self.buckets[index] = self.buckets.get(index, 0) + count
+		self.zero += other.zero
+		self.count += other.count
+		self.sum += other.sum
+		self.max = max(self.max, other.max)
+
+	def report(self):
+		return {"buckets": dict((str(index), count) for index, count in self.buckets.iteritems()),
+			"zero": self.zero, "count": self.count, "sum": self.sum, "max": self.max}
+
+	@classmethod
+	def fromReport(cls, report):
+		sketch = cls()
+		sketch.buckets = dict((int(index), count) for index, count in report["buckets"].iteritems())
+		sketch.zero = report["zero"]
+		sketch.count = report["count"]
+		sketch.sum = report["sum"]
+		sketch.max = report["max"]
+		return sketch
+
+class DelayAnalytics():
+	"""
+	This class aggregates delays of deliveries, see ZimbraMailLog with
+	delays given. Every delivery record (sent, delivered locally,
+	deferred, bounced or discarded) logs the total delay and its four
+	components, and for each of them a DelaySketch is kept for all the
+	deliveries together, and by relay host, by recipient domain and by the
+	final state of the recipient (see MailMessageInstance). Deliveries are
+	added when their message is done, since only then the final state is
+	known.
+
+	Only the first MAX_KEYS relays and domains get their own sketches, the
+	rest are counted together as "(other)", so memory stays bounded over
+	logs of any length.
+	"""
+
+	COMPONENTS = (
+		("delay", "total"),
+		("delay1", "before qmgr"),
+		("delay2", "in queue"),
+		("delay3", "connection"),
+		("delay4", "transmission"),
+	)
+
+	DIMENSIONS = ("relay", "domain", "state")
+
+	QUANTILES = (0.5, 0.95, 0.99)
+
+	MAX_KEYS = 1000
+
+	def __init__(self):
+		self.all = self.sketches()
+		self.groups = dict((dimension, {}) for dimension in self.DIMENSIONS)
+		self.deliveries = 0
+
+		# Positions of fields in records by rule id, see positions, and
+		# delays as logged with their values and bucket indices, since
+		# postfix logs only a few significant digits and they repeat a lot
+		self.rulePositions = {}
+		self.parsed = {}
+
+	def sketches(self):
+		return dict((field, DelaySketch()) for field, label in self.COMPONENTS)
+
+	def group(self, dimension, key):
+		groups = self.groups[dimension]
+		sketches = groups.get(key)
+		if sketches is None:
+			if len(groups) >= self.MAX_KEYS:
+				key = "(other)"
+				sketches = groups.get(key)
+			if sketches is None:
+				sketches = groups[key] = self.sketches()
+		return sketches
+
+	@staticmethod
+	def positions(regex):
+		"""
+		Return the positions of the recipient, the original recipient, the
+		relay and of the components of the delay within the values of a
+		LogRecord of the rule, or None if the rule doesn't log delays.
+		Fields the rule doesn't have get None.
+		"""
+
+		index = regex["index"]
+		if "delay4" not in index:
+			return None
+
+		return index["to"], index.get("orig_to"), index.get("relayhostname"), \
+			[(field, index[field]) for field, label in DelayAnalytics.COMPONENTS]
+
+	def addMessage(self, msg):
+		"""
+		Add the delays of all delivery records of a done message.
+		"""
+
+		instances = msg.message["instances"]
+		for record in msg.message["logRecords"]:
+			positions = self.rulePositions.get(record.ruleid, False)
+			if positions is False:
+				positions = self.rulePositions[record.ruleid] = self.positions(zimbra8[record.ruleid])
+			if positions is None:
+				continue
+
+			toPos, origPos, relayPos, components = positions
+			values = record.values
+
+			# Instances are keyed as in MailMessage.process
+			to = values[toPos]
+			instance = instances.get((to, values[origPos] if origPos is not None else None))
+			state = instance.state if instance is not None else "UNKNOWN"
+			domain = to.rpartition("@")[2].lower() or "(none)"
+			relay = (values[relayPos] if relayPos is not None else None) or "none"
+
+			targets = (self.all, self.group("relay", relay), self.group("domain", domain), self.group("state", state))
+			for field, position in components:
+				text = values[position]
+				parsed = self.parsed.get(text)
+				if parsed is None:
+					if len(self.parsed) >= 100000:
+						self.parsed.clear()
+					value = float(text)
+					parsed = self.parsed[text] = (value, DelaySketch.bucket(value))
+				# The same as DelaySketch.add, inlined
+				value, index = parsed
+				for sketches in targets:
+					sketch = sketches[field]
+					sketch.count += 1
+					sketch.sum += value
+					if value > sketch.max:
+						sketch.max = value
+					if index is None:
+						sketch.zero += 1
+					else:
+						buckets = sketch.buckets
+						buckets[index] = buckets.get(index, 0) + 1
+
+			self.deliveries += 1
+
+	def merge(self, other):
+		for field, label in self.COMPONENTS:
+			self.all[field].merge(other.all[field])
+		for dimension in self.DIMENSIONS:
+			for key, sketches in other.groups[dimension].iteritems():
+				group = self.group(dimension, key)
+				for field, label in self.COMPONENTS:
+					group[field].merge(sketches[field])
+		self.deliveries += other.deliveries
+
+	def report(self):
+		"""
+		Return the sketches as a dictionary, suitable for JSON.
+		"""
+
+		def sketchesReport(sketches):
+			return dict((field, sketch.report()) for field, sketch in sketches.iteritems())
+
+		return {
+			"deliveries": self.deliveries,
+			"all": sketchesReport(self.all),
+			"groups": dict((dimension, dict((key, sketchesReport(sketches)) for key, sketches in groups.iteritems()))
+				for dimension, groups in self.groups.iteritems()),
+		}
+
+	def save(self, filename):
+		"""
+		Write the sketches into a JSON file.
+		"""
+
+		with open(filename, "w") as out:
+			json.dump(self.report(), out, sort_keys=True)
+
+	@classmethod
+	def load(cls, filename):
+		"""
+		Read the sketches written by save, so that delays of several runs,
+		e.g. of logs of different months, add up.
+		"""
+
+		with open(filename) as f:
+			report = json.load(f)
+
+		def sketchesFromReport(sketches):
+			return dict((str(field), DelaySketch.fromReport(sketch)) for field, sketch in sketches.iteritems())
+
+		analytics = cls()
+		analytics.deliveries = report["deliveries"]
+		analytics.all = sketchesFromReport(report["all"])
+		for dimension, groups in report["groups"].iteritems():
+			analytics.groups[str(dimension)] = dict((key, sketchesFromReport(sketches)) for key, sketches in groups.iteritems())
+		return analytics
+
+	def table(self, output=sys.stderr, limit=20):
+		"""
+		Print the quantiles of every component for all deliveries, and by
+		relay, domain and state, with at most limit keys of every
+		dimension, the ones with the most deliveries.
+		"""
+
+		def formatDelay(value):
+			return "{:.2f}".format(value) if value is not None else "-"
+
+		def rows(name, sketches):
+			for field, label in self.COMPONENTS:
+				sketch = sketches[field]
+				quantiles = [formatDelay(sketch.quantile(q)) for q in self.QUANTILES]
+				print >>output, "{:<40} {:<14} {:>10} {:>10} {:>10} {:>10} {:>10}".format(name, label, sketch.count, *(quantiles + [formatDelay(sketch.max)]))
+				name = ""
+
+		def header(name):
+			print >>output, "{:<40} {:<14} {:>10} {:>10} {:>10} {:>10} {:>10}".format(name, "delay [s]", "count", "p50", "p95", "p99", "max")
+
+		print >>output, "{} deliveries".format(self.deliveries)
+		print >>output
+		header("")
+		rows("all", self.all)
+
+		for dimension in self.DIMENSIONS:
+			groups = self.groups[dimension]
+			print >>output
+			header(dimension)
+			for key, sketches in sorted(groups.iteritems(), key=lambda item: item[1]["delay"].count, reverse=True)[:limit]:
+				rows(key, sketches)
+			if len(groups) > limit:
+				print >>output, "... {} more".format(len(groups) - limit)
+
+################################################################################
+# Metrics
+################################################################################
+
+class LatencyHistogram():
+	"""
+	This class counts observed latencies, in seconds, into buckets with
+	fixed upper bounds, as a Prometheus histogram does. Counts are kept per
+	bucket and made cumulative only when rendered.
+	"""
+
+	BOUNDS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.01, 0.1)
+
+	def __init__(self, bounds=BOUNDS):
+		self.bounds = bounds
+		self.counts = [0] * (len(bounds) + 1)
+		self.sum = 0.0
+
+	def observe(self, value):
+		self.counts[bisect.bisect_left(self.bounds, value)] += 1
+		self.sum += value
+
+	def render(self, name, help):
+		lines = ["# HELP {} {}".format(name, help), "# TYPE {} histogram".format(name)]
+
+		# Counts might change while they are read by the metrics server
+		counts = list(self.counts)
+		total = 0
+		for bound, count in zip(self.bounds + ("+Inf",), counts):
+			total += count
+			lines.append('{}_bucket{{le="{}"}} {}'.format(name, bound, total))
+		lines.append("{}_sum {!r}".format(name, self.sum))
+		lines.append("{}_count {}".format(name, total))
+
+		return lines
+
+class ParserMetrics():
+	"""
+	This class renders the counters of a ZimbraMailLog in the Prometheus
+	text format. ZimbraMailLog keeps the counters itself as plain integers,
+	so nothing is done per line for metrics, and the values are read only
+	when metrics are requested, possibly from another thread.
+	"""
+
+	def __init__(self, mailLog, lineFilter=None):
+		self.mailLog = mailLog
+		self.lineFilter = lineFilter
+
+	def render(self):
+		mailLog = self.mailLog
+		lines = []
+
+		def metric(name, kind, help, samples):
+			lines.append("# HELP {} {}".format(name, help))
+			lines.append("# TYPE {} {}".format(name, kind))
+			for labels, value in samples:
+				lines.append("{}{} {}".format(name, labels, value))
+
+		metric("maillog_lines_parsed_total", "counter", "Lines parsed.", [("", mailLog.linesParsed)])
+		metric("maillog_bytes_read_total", "counter", "Bytes of lines parsed.", [("", mailLog.bytesRead)])
+		metric("maillog_unmatched_lines_total", "counter", "Lines that no rule matched.", [("", mailLog.unmatchedLines)])
+		metric("maillog_violations_total", "counter", "Lines rejected by state machines, in tolerant mode.", [("", mailLog.violations)])
+		metric("maillog_processes_in_flight", "gauge", "Processes currently tracked by PID.", [("", len(mailLog.stateProcessPID))])
+		metric("maillog_messages_in_flight", "gauge", "Messages currently tracked by queue ID.", [("", len(mailLog.mailMessagesByQueueID))])
+		metric("maillog_completed_deliveries_total", "counter", "Recipients of completed or expired messages by final state.",
+			[('{{state="{}"}}'.format(state), count) for state, count in sorted(mailLog.completedStates.items())])
+		metric("maillog_expired_total", "counter", "Expired processes and messages.",
+			[('{{kind="{}"}}'.format(kind), count) for kind, count in sorted(mailLog.expiredCounters.items())])
+
+		if self.lineFilter is not None:
+			metric("maillog_dropped_lines_total", "counter", "Lines skipped by the pre-filter, by class.",
+				[('{{class="{}"}}'.format(name), count) for name, count in sorted(self.lineFilter.dropped.items())])
+
+		lines.extend(mailLog.lineLatency.render("maillog_line_latency_seconds", "Time to parse and process a line, sampled."))
+
+		if mailLog.delays is not None:
+			lines.append("# HELP maillog_delivery_delay_seconds Delays of deliveries of done messages, by component.")
+			lines.append("# TYPE maillog_delivery_delay_seconds summary")
+			for field, label in DelayAnalytics.COMPONENTS:
+				sketch = mailLog.delays.all[field]
+				labels = 'component="{}"'.format(label.replace(" ", "_"))
+				for q in DelayAnalytics.QUANTILES:
+					value = sketch.quantile(q)
+					lines.append('maillog_delivery_delay_seconds{{{},quantile="{}"}} {}'.format(labels, q, value if value is not None else "NaN"))
+				lines.append("maillog_delivery_delay_seconds_sum{{{}}} {!r}".format(labels, sketch.sum))
+				lines.append("maillog_delivery_delay_seconds_count{{{}}} {}".format(labels, sketch.count))
+
+		logTime = mailLog.timestamps.lastEpoch
+		if logTime is not None:
+			# Log time is local time, see LagMeter
+			metric("maillog_last_log_time_seconds", "gauge", "Log time of the last line, as if it were UTC.", [("", logTime)])
+			metric("maillog_ingest_lag_seconds", "gauge", "Current time minus log time of the last line.", [("", calendar.timegm(time.localtime()) - logTime)])
+
+		return "\n".join(lines) + "\n"
+
+class MetricsServer():
+	"""
+	This class serves metrics over HTTP at /metrics from a daemon thread.
+	"""
+
+	def __init__(self, metrics, port, address="127.0.0.1"):
+
+		class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+			def do_GET(self):
+				if self.path.split("?")[0] != "/metrics":
+					self.send_error(404)
+					return
+
+				body = metrics.render()
+				self.send_response(200)
+				self.send_header("Content-Type", "text/plain; version=0.0.4")
+				self.send_header("Content-Length", str(len(body)))
+				self.end_headers()
+				self.wfile.write(body)
+
+			def log_message(self, format, *args):
+				pass
+
+		self.server = BaseHTTPServer.HTTPServer((address, port), MetricsHandler)
+		self.thread = threading.Thread(target=self.server.serve_forever)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def close(self):
+		self.server.shutdown()
+		self.server.server_close()
+
+################################################################################
+# Message store
+################################################################################
+
+def epochTimestamp(timestamp):
+	"""
+	Convert a timestamp of a log record, either datetime or epoch seconds,
+	into epoch seconds.
+	"""
+
+	if isinstance(timestamp, datetime):
+		return calendar.timegm(timestamp.timetuple())
+
+	return timestamp
+
+class MessageStore():
+	"""
+	SQLite database of processed messages, their recipients and log lines,
+	so that questions about them can be answered without parsing logs
+	again. Messages are written in batches of batchSize in one transaction,
+	and the database uses write-ahead logging, so that it can be queried
+	while it is being written.
+
+	Timestamps are stored as epoch seconds of the log's local time.
+
+	A message is identified by its hostname, queue ID and the time it was
+	first seen, so when a log is stored again, e.g. a longer version of
+	it, messages already in the database are replaced together with their
+	recipients and lines instead of being added twice.
+	"""
+
+	SCHEMA = """
+		CREATE TABLE IF NOT EXISTS messages (
+			id INTEGER PRIMARY KEY,
+			hostname TEXT,
+			queueid TEXT,
+			messageid TEXT,
+			sender TEXT COLLATE NOCASE,
+			source TEXT,
+			clienthostname TEXT,
+			clienthostip TEXT,
+			state TEXT,
+			expired INTEGER,
+			first_seen INTEGER,
+			last_seen INTEGER
+		);
+
+		CREATE TABLE IF NOT EXISTS recipients (
+			message INTEGER REFERENCES messages(id),
+			rcpt_to TEXT COLLATE NOCASE,
+			orig_to TEXT COLLATE NOCASE,
+			state TEXT,
+			relayhostname TEXT,
+			relayhostip TEXT,
+			relayport TEXT,
+			newqueueid TEXT
+		);
+
+		CREATE TABLE IF NOT EXISTS lines (
+			message INTEGER REFERENCES messages(id),
+			timestamp INTEGER,
+			line TEXT
+		);
+
+		CREATE INDEX IF NOT EXISTS messages_queueid ON messages(queueid);
+		CREATE INDEX IF NOT EXISTS messages_messageid ON messages(messageid);
+		CREATE INDEX IF NOT EXISTS messages_sender ON messages(sender);
+		CREATE INDEX IF NOT EXISTS messages_clienthostip ON messages(clienthostip);
+		CREATE INDEX IF NOT EXISTS messages_first_seen ON messages(first_seen);
+		CREATE INDEX IF NOT EXISTS messages_state ON messages(state);
+		CREATE INDEX IF NOT EXISTS recipients_message ON recipients(message);
+		CREATE INDEX IF NOT EXISTS recipients_rcpt_to ON recipients(rcpt_to);
+		CREATE INDEX IF NOT EXISTS recipients_orig_to ON recipients(orig_to);
+		CREATE INDEX IF NOT EXISTS recipients_state ON recipients(state);
+		CREATE INDEX IF NOT EXISTS lines_message ON lines(message);
+	"""
+
+	UNIQUE_INDEX = "CREATE UNIQUE INDEX IF NOT EXISTS messages_unique ON messages(hostname, queueid, first_seen)"
+
+	def __init__(self, filename, batchSize=1000):
+		self.db = sqlite3.connect(filename)
+		self.db.text_factory = str
+		self.db.execute("PRAGMA journal_mode=WAL")
+		self.db.execute("PRAGMA synchronous=NORMAL")
+		self.db.executescript(self.SCHEMA)
+		try:
+			self.db.execute(self.UNIQUE_INDEX)
+		except sqlite3.IntegrityError:
+			# Written before messages were unique, so a log might have been
+			# stored more than once
+			self.removeDuplicates()
+			self.db.execute(self.UNIQUE_INDEX)
+
+		self.batchSize = batchSize
+		self.pending = 0
+
+	def add(self, msg):
+		"""
+		Write a processed message into the database.
+		"""
+
+		logRecords = msg.message["logRecords"]
+		timestamps = [epochTimestamp(logRecord["timestamp"]) for logRecord in logRecords]
+		firstSeen = min(timestamps or [None])
+
+		for rowid, in self.db.execute("SELECT id FROM messages WHERE hostname = ? AND queueid IS ? AND first_seen IS ?", (msg.getHostname(), msg.getQueueID(), firstSeen)).fetchall():
+			self.remove(rowid)
+
+		cursor = self.db.execute("INSERT INTO messages (hostname, queueid, messageid, sender, source, clienthostname, clienthostip, state, expired, first_seen, last_seen) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+			(msg.getHostname(), msg.getQueueID(), msg.getMessageID(), msg.getMailFrom(),
+			msg.message["source"], msg.message["clienthostname"], msg.message["clienthostip"],
+			msg.state, msg.expired, firstSeen, max(timestamps or [None])))
+		rowid = cursor.lastrowid
+
+		self.db.executemany("INSERT INTO recipients (message, rcpt_to, orig_to, state, relayhostname, relayhostip, relayport, newqueueid) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+			[(rowid, rcpt_to, orig_to, instance.state, instance.relayhostname, instance.relayhostip, instance.relayport, instance.newqueueid)
+				for (rcpt_to, orig_to), instance in msg.message["instances"].items()])
+
+		self.db.executemany("INSERT INTO lines (message, timestamp, line) VALUES (?, ?, ?)",
+			[(rowid, timestamp, logRecord["all"].rstrip("\n")) for timestamp, logRecord in zip(timestamps, logRecords)])
+
+		self.pending += 1
+		if self.pending >= self.batchSize:
+			self.commit()
+
+	def remove(self, rowid):
+		"""
+		Remove a message with its recipients and lines.
+		"""
+
+		self.db.execute("DELETE FROM recipients WHERE message = ?", (rowid,))
+		self.db.execute("DELETE FROM lines WHERE message = ?", (rowid,))
+		self.db.execute("DELETE FROM messages WHERE id = ?", (rowid,))
+
+	def removeDuplicates(self):
+		"""
+		Remove all but the last stored of messages with the same hostname,
+		queue ID and first seen time.
+		"""
+
+		for rowid, in self.db.execute("SELECT id FROM messages WHERE id NOT IN (SELECT MAX(id) FROM messages GROUP BY hostname, queueid, first_seen)").fetchall():
+			self.remove(rowid)
+		self.db.commit()
+
+	def commit(self):
+		self.db.commit()
+		self.pending = 0
+
+	def close(self):
+		self.commit()
+		self.db.close()
+
+	def query(self, queueid=None, messageid=None, address=None, clienthostip=None,
+			since=None, until=None, status=None, limit=None):
+		"""
+		Return rows of messages that match all the given conditions, ordered
+		by the time they were first seen. Address matches sender or any
+		recipient, and status matches the state of the message or of any
+		recipient. Since and until are epoch seconds.
+		"""
+
+		conditions = []
+		parameters = []
+
+		if queueid is not None:
+			conditions.append("queueid = ?")
+			parameters.append(queueid)
+
+		if messageid is not None:
+			conditions.append("messageid = ?")
+			parameters.append(messageid)
+
+		if address is not None:
+			conditions.append("id IN (SELECT id FROM messages WHERE sender = ? UNION SELECT message FROM recipients WHERE rcpt_to = ? UNION SELECT message FROM recipients WHERE orig_to = ?)")
+			parameters.extend([address] * 3)
+
+		if clienthostip is not None:
+			conditions.append("clienthostip = ?")
+			parameters.append(clienthostip)
+
+		if since is not None:
+			conditions.append("first_seen >= ?")
+			parameters.append(since)
+
+		if until is not None:
+			conditions.append("first_seen < ?")
+			parameters.append(until)
+
+		if status is not None:
+			conditions.append("id IN (SELECT id FROM messages WHERE state = ? UNION SELECT message FROM recipients WHERE state = ?)")
+			parameters.extend([status] * 2)
+
+		sql = "SELECT id, first_seen, hostname, queueid, messageid, sender, state FROM messages"
+		if conditions:
+			sql += " WHERE " + " AND ".join(conditions)
+		sql += " ORDER BY first_seen"
+		if limit is not None:
+			sql += " LIMIT ?"
+			parameters.append(limit)
+
+		return self.db.execute(sql, parameters).fetchall()
+
+	def recipients(self, rowid):
+		return self.db.execute("SELECT rcpt_to, orig_to, state, relayhostname FROM recipients WHERE message = ?", (rowid,)).fetchall()
+
+	def lines(self, rowid):
+		return [line for line, in self.db.execute("SELECT line FROM lines WHERE message = ? ORDER BY rowid", (rowid,))]
+
+def parseQueryTime(value):
+	"""
+	Parse time given as YYYY-MM-DD, optionally followed by HH:MM or
+	HH:MM:SS, into epoch seconds in the same form as in MessageStore.
+	"""
+
+	for format in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d"):
+		try:
+			return calendar.timegm(datetime.strptime(value, format).timetuple())
+		except ValueError:
+			pass
+
+	raise ValueError("Invalid time: {}".format(value))
+
+################################################################################
+# Event table
+################################################################################
+
+class EventTable():
+	"""
+	Columnar table of log records, one row per record, for reports over
+	millions of records with NumPy. Numeric columns are kept in NumPy
+	arrays, and string columns as integer codes into a list of distinct
+	values, so that counting by a column, histograms and bucketing by time
+	are single vectorized operations. Missing values are -1 in integer
+	columns and codes, and NaN in float columns.
+
+	Rows are gathered in lists and copied into the arrays CHUNK rows at a
+	time. Arrays are preallocated and grow by doubling. The table can be
+	saved into a .npz file and loaded back.
+
+	NumPy is needed only for this class, and is imported when a table is
+	made.
+	"""
+
+	# Column name, NumPy type, field of the record and the conversion of
+	# its value. Timestamp and rule are taken from every record.
+	NUMERIC = (
+		("size", "i8", "size", int),
+		("nrcpt", "i4", "nrcpt", int),
+		("delay", "f8", "delay", float),
+		("delay1", "f8", "delay1", float),
+		("delay2", "f8", "delay2", float),
+		("delay3", "f8", "delay3", float),
+		("delay4", "f8", "delay4", float),
+		("dsnclass", "i1", "dsn", lambda value: int(value[0])),
+		("relayport", "i4", "relayport", int),
+	)
+
+	# Column name and field of the record of dictionary encoded columns
+	STRINGS = (
+		("hostname", "hostname"),
+		("sender", "from"),
+		("recipient", "to"),
+		("relay", "relayhostname"),
+		("client", "clienthostip"),
+	)
+
+	CHUNK = 8192
+
+	def __init__(self, capacity=65536):
+		import numpy
+		self.numpy = numpy
+
+		self.types = [("timestamp", "i8"), ("rule", "i2")] + \
+			[(name, type) for name, type, field, convert in self.NUMERIC] + \
+			[(name, "i4") for name, field in self.STRINGS]
+		self.arrays = dict((name, numpy.empty(capacity, type)) for name, type in self.types)
+		self.capacity = capacity
+		self.size = 0
+		self.pending = []
+
+		# Distinct values of string columns and their codes
+		self.strings = dict((name, []) for name, field in self.STRINGS)
+		self.codes = dict((name, {}) for name, field in self.STRINGS)
+
+		# For every rule id, how its records are made into rows, see plan
+		self.plans = {}
+
+		# Epoch of the last timestamp, since consecutive records mostly have
+		# the same one
+		self.lastTimestamp = None
+		self.lastEpoch = None
+
+		# Names of the rules by id, if the table was loaded, since the rules
+		# might have changed since it was saved
+		self.ruleNames = None
+
+	def plan(self, regex):
+		"""
+		Return how records of the rule are made into rows: the row with
+		missing values in all the columns but the rule, and for the numeric
+		and the string columns of the fields the rule has, the column
+		within the row, the position of the field within the values of a
+		LogRecord and the conversion, or the column name for string
+		columns.
+		"""
+
+		index = regex["index"]
+		row = [None, regex["id"]] + [float("nan") if type == "f8" else -1 for name, type, field, convert in self.NUMERIC] + [-1] * len(self.STRINGS)
+
+		numeric = [(column + 2, index[field], convert)
+			for column, (name, type, field, convert) in enumerate(self.NUMERIC) if field in index]
+		strings = [(column + 2 + len(self.NUMERIC), index[field], name)
+			for column, (name, field) in enumerate(self.STRINGS) if field in index]
+
+		return row, numeric, strings
+
+	def add(self, record):
+		"""
+		Add a row for a log record.
+		"""
+
+		plan = self.plans.get(record.ruleid)
+		if plan is None:
+			plan = self.plans[record.ruleid] = self.plan(zimbra8[record.ruleid])
+
+		template, numeric, strings = plan
+		values = record.values
+		row = template[:]
+
+		timestamp = values[1]
+		if timestamp != self.lastTimestamp:
+			self.lastTimestamp = timestamp
+			self.lastEpoch = epochTimestamp(timestamp)
+		row[0] = self.lastEpoch
+
+		for column, position, convert in numeric:
+			value = values[position]
+			if value:
+				try:
+					row[column] = convert(value)
+				except ValueError:
+					pass
+
+		for column, position, name in strings:
+			value = values[position]
+			if value is not None:
+				codes = self.codes[name]
+				code = codes.get(value)
+				if code is None:
+					code = codes[value] = len(codes)
+					self.strings[name].append(value)
+				row[column] = code
+
+		self.pending.append(row)
+		if len(self.pending) >= self.CHUNK:
+			self.flush()
+
+	def flush(self):
+		"""
+		Copy gathered rows into the arrays.
+		"""
+
+		if not self.pending:
+			return
+
+		size = self.size + len(self.pending)
+		if size > self.capacity:
+			capacity = max(2 * self.capacity, size)
+			for name, type in self.types:
+				array = self.numpy.empty(capacity, type)
+				array[:self.size] = self.arrays[name][:self.size]
+				self.arrays[name] = array
+			self.capacity = capacity
+
+		# All the values fit into doubles exactly, timestamps included
+		rows = self.numpy.array(self.pending, "f8")
+		for column, (name, type) in enumerate(self.types):
+			self.arrays[name][self.size:size] = rows[:, column]
+
+		self.size = size
+		del self.pending[:]
+
+	def column(self, name):
+		"""
+		Return the array of a column, without the unused capacity.
+		"""
+
+		self.flush()
+		return self.arrays[name][:self.size]
+
+	def save(self, filename):
+		"""
+		Write the table into a .npz file. Distinct values of a string
+		column are saved as "<column>_values", and names of the rules by
+		their ids as "rule_names".
+		"""
+
+		numpy = self.numpy
+		arrays = dict((name, self.column(name)) for name, type in self.types)
+		for name, strings in self.strings.iteritems():
+			arrays[name + "_values"] = numpy.array(strings, dtype=str)
+		arrays["rule_names"] = numpy.array([regex["name"] for regex in zimbra8], dtype=str)
+
+		numpy.savez_compressed(filename, **arrays)
+
+	@classmethod
+	def load(cls, filename):
+		"""
+		Read a table written by save.
+		"""
+
+		import numpy
+
+		data = numpy.load(filename)
+		table = cls(capacity=len(data["timestamp"]))
+		for name, type in table.types:
+			table.arrays[name] = data[name]
+		for name, strings in table.strings.iteritems():
+			strings.extend(data[name + "_values"].tolist())
+			table.codes[name] = dict((value, code) for code, value in enumerate(strings))
+		table.size = table.capacity
+		table.ruleNames = data["rule_names"].tolist()
+		data.close()
+		return table
+
+	def counts(self, name, limit=None):
+		"""
+		Return (value, count) pairs of a column with the most frequent
+		values first. Values of string columns are decoded, and rule ids
+		are given by rule names. Missing values are left out.
+		"""
+
+		numpy = self.numpy
+		column = self.column(name)
+
+		if name in self.strings:
+			codes = column[column >= 0]
+			counts = numpy.bincount(codes, minlength=len(self.strings[name]))
+			values = self.strings[name]
+		else:
+			if column.dtype.kind == "f":
+				column = column[~numpy.isnan(column)]
+			else:
+				column = column[column >= 0]
+			values, counts = numpy.unique(column, return_counts=True)
+			values = values.tolist()
+			if name == "rule":
+				names = self.ruleNames or [regex["name"] for regex in zimbra8]
+				values = [names[ruleid] for ruleid in values]
+
+		order = numpy.argsort(-counts, kind="mergesort")[:limit]
+		return [(values[i], int(counts[i])) for i in order if counts[i]]
+
+	def timeBuckets(self, seconds):
+		"""
+		Return (start, count) pairs of rows in buckets of the given number of
+		seconds, from the first to the last timestamp, with start in epoch
+		seconds.
+		"""
+
+		numpy = self.numpy
+		timestamps = self.column("timestamp")
+		if not len(timestamps):
+			return []
+
+		first = timestamps.min() // seconds * seconds
+		counts = numpy.bincount((timestamps - first) // seconds)
+		return [(int(first + i * seconds), int(count)) for i, count in enumerate(counts)]
+
+	def histogram(self, name, bins=10):
+		"""
+		Return (lower bound, upper bound, count) of bins with logarithmic
+		bounds over positive values of a numeric column, e.g. of delays.
+		"""
+
+		numpy = self.numpy
+		column = self.column(name).astype("f8")
+		column = column[~numpy.isnan(column)]
+		column = column[column > 0]
+		if not len(column):
+			return []
+		if column.min() == column.max():
+			return [(column.min(), column.max(), len(column))]
+
+		counts, bounds = numpy.histogram(column, numpy.logspace(numpy.log10(column.min()), numpy.log10(column.max()), bins + 1))
+		return [(bounds[i], bounds[i + 1], int(count)) for i, count in enumerate(counts)]
+
+def queryMain(argv):
+
+	import argparse
+
+	parser = argparse.ArgumentParser(prog="LogParser.py query", description="Query messages stored with --db")
+	parser.add_argument("--queueid", help="queue ID of the message")
+	parser.add_argument("--messageid", help="message ID of the message")
+	parser.add_argument("--address", help="sender or recipient address")
+	parser.add_argument("--client", metavar="IP", help="IP address of the client that sent the message")
+	parser.add_argument("--since", type=parseQueryTime, metavar="TIME", help="messages first seen at or after TIME (YYYY-MM-DD [HH:MM[:SS]])")
+	parser.add_argument("--until", type=parseQueryTime, metavar="TIME", help="messages first seen before TIME")
+	parser.add_argument("--status", help="state of the message or of any of its recipients, e.g. MESSAGE_BOUNCED")
+	parser.add_argument("--limit", type=int, help="print at most LIMIT messages")
+	parser.add_argument("--lines", action="store_true", help="print log lines of messages")
+	parser.add_argument("db", help="database written with --db")
+	args = parser.parse_args(argv)
+
+	store = MessageStore(args.db)
+	for rowid, firstSeen, hostname, queueid, messageid, sender, state in store.query(args.queueid,
+			args.messageid, args.address, args.client, args.since, args.until, args.status, args.limit):
+
+		print "{} {} [QUEUEID {}] messageid={} from={} state={}".format(datetime.utcfromtimestamp(firstSeen) if firstSeen is not None else "-", hostname, queueid, messageid, sender, state)
+		for rcpt_to, orig_to, rcptState, relayhostname in store.recipients(rowid):
+			print "\t-> {}{} {}{}".format(rcpt_to, " (orig {})".format(orig_to) if orig_to else "", rcptState, " relay={}".format(relayhostname) if relayhostname else "")
+
+		if args.lines:
+			for line in store.lines(rowid):
+				print "\t" + line
+
+def eventsMain(argv):
+
+	import argparse
+
+	parser = argparse.ArgumentParser(prog="LogParser.py events", description="Report on log records stored with --events")
+	parser.add_argument("--by", metavar="COLUMN", action="append", help="count records by values of COLUMN, e.g. rule, relay, recipient, dsnclass; can be given several times")
+	parser.add_argument("--interval", type=int, metavar="SECONDS", help="count records in intervals of SECONDS of log time")
+	parser.add_argument("--histogram", metavar="COLUMN", help="histogram of positive values of COLUMN, e.g. delay, size")
+	parser.add_argument("--bins", type=int, default=10, help="number of bins of the histogram (default 10)")
+	parser.add_argument("--limit", type=int, default=20, help="print at most LIMIT values of every --by column (default 20)")
+	parser.add_argument("events", help="file written with --events")
+	args = parser.parse_args(argv)
+
+	try:
+		table = EventTable.load(args.events)
+	except ImportError:
+		parser.error("reports need NumPy")
+
+	timestamps = table.column("timestamp")
+	if table.size:
+		print "{} records, {} to {}".format(table.size, datetime.utcfromtimestamp(timestamps.min()), datetime.utcfromtimestamp(timestamps.max()))
+	else:
+		print "0 records"
+
+	for name in args.by or []:
+		if name not in table.arrays:
+			parser.error("unknown column {}, one of: {}".format(name, ", ".join(sorted(table.arrays))))
+		print
+		print "{:<50} {:>10}".format(name, "records")
+		for value, count in table.counts(name, args.limit):
+			print "{:<50} {:>10}".format(value, count)
+
+	if args.interval:
+		print
+		print "{:<20} {:>10}".format("interval", "records")
+		for start, count in table.timeBuckets(args.interval):
+			print "{:<20} {:>10}".format(str(datetime.utcfromtimestamp(start)), count)
+
+	if args.histogram:
+		if args.histogram not in table.arrays or args.histogram in table.strings:
+			parser.error("not a numeric column: {}".format(args.histogram))
+		print
+		print "{:>12} {:>12} {:>10}".format(args.histogram + " from", "to", "records")
+		for lower, upper, count in table.histogram(args.histogram, args.bins):
+			print "{:>12.4g} {:>12.4g} {:>10}".format(lower, upper, count)
+
+def main(argv):
+
+	if argv and argv[0] == "query":
+		return queryMain(argv[1:])
+
+	if argv and argv[0] == "events":
+		return eventsMain(argv[1:])
+
+	import argparse
+
+	parser = argparse.ArgumentParser(description="Parse Zimbra postfix mail log", epilog="Messages stored with --db are queried with: %(prog)s query --help")
+	parser.add_argument("--stream", action="store_true", help="print every message as soon as it is done, without keeping it in memory")
+	parser.add_argument("--expire", type=int, metavar="SECONDS", help="remove processes and messages that didn't log anything for SECONDS of log time")
+	parser.add_argument("--workers", type=int, metavar="N", help="classify lines in N worker processes")
+	parser.add_argument("--checkpoint", metavar="FILE", help="continue from the state saved in FILE, and save the state there when done")
+	parser.add_argument("--follow", action="store_true", help="keep reading the log as it grows, and reopen it when it is rotated; implies --stream")
+	parser.add_argument("--lag-interval", type=int, default=60, metavar="SECONDS", help="with --follow, report processing lag every SECONDS (default 60)")
+	parser.add_argument("--rotation-set", action="store_true", help="filename is a directory or a glob of rotated logs, which are parsed in chronological order")
+	parser.add_argument("--db", metavar="FILE", help="store processed messages in SQLite database FILE, see the query command")
+	parser.add_argument("--profile", action="store_true", help="profile matching of rules and state machines, and print the profile to standard error")
+	parser.add_argument("--profile-json", metavar="FILE", help="profile as with --profile, and also write the profile as JSON into FILE")
+	parser.add_argument("--quarantine", metavar="FILE", help="don't stop at lines no rule matches or a state machine rejects, but write them into FILE, and their templates into FILE.summary")
+	parser.add_argument("--drop", metavar="CLASS[,CLASS...]", help="skip lines of these classes before classification, or all of them with 'all': " + ", ".join(sorted(LineFilter.DROP_CLASSES)))
+	parser.add_argument("--target", action="append", metavar="VALUE", help="parse only lines related to the queue ID, address or client IP; can be given several times")
+	parser.add_argument("--mmap", action="store_true", help="match rules directly within the memory mapped log, or within large blocks of a compressed log, instead of reading it line by line")
+	parser.add_argument("--offsets", action="store_true", help="keep only offsets of lines in log records, and read the lines back from the memory mapped log when needed")
+	parser.add_argument("--delays", action="store_true", help="print p50, p95 and p99 of delivery delays and their components, by relay, recipient domain and final state, to standard error")
+	parser.add_argument("--delays-json", metavar="FILE", help="as with --delays, and also keep the delay sketches in FILE, adding to the ones already there")
+	parser.add_argument("--events", metavar="FILE", help="keep every log record as a row of a NumPy table, and save it into FILE (.npz), see the events command")
+	parser.add_argument("--rule-cache", metavar="DIR", default=RuleCache.defaultDirectory(), help="keep compiled rules in DIR (default %(default)s)")
+	parser.add_argument("--no-rule-cache", action="store_true", help="compile the rules on every start")
+	parser.add_argument("--metrics-port", type=int, metavar="PORT", help="serve metrics in Prometheus text format at http://ADDRESS:PORT/metrics")
+	parser.add_argument("--metrics-address", default="127.0.0.1", metavar="ADDRESS", help="address to serve metrics at (default 127.0.0.1)")
+	parser.add_argument("filenames", nargs="+", metavar="filename", help="name of the maillog file, optionally xz or gzip compressed; logs of several hosts are merged by timestamps")
+	args = parser.parse_args(argv)
+
+	multiHost = len(args.filenames) > 1
+	if multiHost and (args.follow or args.checkpoint):
+		parser.error("--follow and --checkpoint work only with a single log")
+
+	if args.follow and args.workers:
+		parser.error("--follow can't be used with --workers")
+
+	if args.rotation_set and (args.workers or args.follow or args.checkpoint):
+		parser.error("--rotation-set can't be used with --workers, --follow or --checkpoint")
+
+	profile = args.profile or args.profile_json is not None
+	if profile and args.workers:
+		parser.error("--profile can't be used with --workers")
+
+	if args.mmap and (multiHost or args.workers or args.follow or args.checkpoint or args.rotation_set or profile or args.drop or args.target):
+		parser.error("--mmap works only with a single log, and without --workers, --follow, --checkpoint, --rotation-set, --profile, --drop or --target")
+
+	# Lines are read back from the log itself, which has to be a plain
+	# file that is read directly
+	if args.offsets:
+		if multiHost or args.follow or args.checkpoint or args.rotation_set or args.drop or args.target:
+			parser.error("--offsets works only with a single log, and without --follow, --checkpoint, --rotation-set, --drop or --target")
+		if args.filenames[0].endswith(".xz") or args.filenames[0].endswith(".gz") or not os.path.isfile(args.filenames[0]):
+			parser.error("--offsets works only with plain log files")
+
+	def reportProfile(mailLog):
+		if profile:
+			mailLog.profile.table()
+			if args.profile_json:
+				mailLog.profile.save(args.profile_json)
+
+	quarantine = None
+	if args.quarantine:
+		quarantine = LogQuarantine(args.quarantine)
+
+	ruleCache = None if args.no_rule_cache else args.rule_cache
+
+	delays = None
+	if args.delays_json and os.path.exists(args.delays_json):
+		delays = DelayAnalytics.load(args.delays_json)
+	elif args.delays or args.delays_json:
+		delays = DelayAnalytics()
+
+	def reportDelays():
+		if delays is not None:
+			delays.table()
+			if args.delays_json:
+				delays.save(args.delays_json)
+
+	events = None
+	if args.events:
+		try:
+			events = EventTable()
+		except ImportError:
+			parser.error("--events needs NumPy")
+
+	def saveEvents():
+		if events is not None:
+			events.save(args.events)
+			print >>sys.stderr, "Saved {} records into {}".format(events.size, args.events)
+
+	def serveMetrics(mailLog):
+		if args.metrics_port is not None:
+			MetricsServer(ParserMetrics(mailLog, lineFilter), args.metrics_port, args.metrics_address)
+
+	# Files of every log, there are more of them in a rotation set
+	logs = []
+	for filename in args.filenames:
+		if args.rotation_set:
+			filenames = rotationSet(filename)
+			if not filenames:
+				parser.error("no log files match {}".format(filename))
+			print >>sys.stderr, "Rotation set: {}".format(" ".join(filenames))
+		else:
+			filenames = [filename]
+		logs.append(filenames)
+
+	# A log was written at the latest when it was last modified, and the
+	# oldest file of a rotation set determines the year of the first
+	# timestamp
+	references = [datetime.fromtimestamp(os.stat(filenames[0]).st_mtime) for filenames in logs]
+	reference = min(references)
+
+	filename = args.filenames[0]
+
+	lineFilter = None
+	if args.drop or args.target:
+		drop = []
+		if args.drop == "all":
+			drop = sorted(LineFilter.DROP_CLASSES)
+		elif args.drop:
+			drop = args.drop.split(",")
+			for name in drop:
+				if name not in LineFilter.DROP_CLASSES:
+					parser.error("unknown drop class {}".format(name))
+
+		lineFilter = LineFilter(drop, args.target)
+
+	if args.target:
+		if args.follow or args.checkpoint:
+			parser.error("--target can't be used with --follow or --checkpoint")
+
+		def allLines():
+			for filenames in logs:
+				for name in filenames:
+					logFile = openLog(name)
+					try:
+						for line in logFile:
+							yield line
+					finally:
+						logFile.close()
+
+		lineFilter.discover(allLines)
+		print >>sys.stderr, "Targets: {} queue IDs found in {} passes".format(len(lineFilter.queueids), lineFilter.passes)
+
+	if args.follow:
+		if args.checkpoint:
+			parser.error("--follow can't be used with --checkpoint")
+
+		mailLog = ZimbraMailLog(retainProcessed=False, expireAfter=args.expire, profile=profile, quarantine=quarantine, ruleCache=ruleCache, delays=delays, events=events)
+		serveMetrics(mailLog)
+		follower = LogFollower(filename)
+		lagMeter = LagMeter(mailLog, args.lag_interval)
+		lines = follower
+		if lineFilter is not None:
+			lines = lineFilter.lines(follower)
+		try:
+			for msg in mailLog.iterMessages(lagMeter.lines(lines), reference, args.workers):
+				print msg
+				sys.stdout.flush()
+		except KeyboardInterrupt:
+			lagMeter.report()
+			reportProfile(mailLog)
+			reportDelays()
+			saveEvents()
+			if quarantine is not None:
+				quarantine.close()
+			if lineFilter is not None:
+				print >>sys.stderr, "Pre-filter dropped: {}".format(lineFilter.report())
+			print >>sys.stderr, "Followed {} rotations and {} truncations".format(follower.rotations, follower.truncations)
+		return
+
+	checkpoint = None
+	if args.checkpoint:
+		if filename.endswith(".xz") or filename.endswith(".gz"):
+			parser.error("--checkpoint works only with plain log files")
+
+		checkpoint = LogCheckpoint(args.checkpoint)
+
+	mailLog = ZimbraMailLog(keepLines=not args.offsets, retainProcessed=not (args.stream or args.db), expireAfter=args.expire, multiHost=multiHost, profile=profile, quarantine=quarantine, ruleCache=ruleCache, delays=delays, events=events)
+	serveMetrics(mailLog)
+
+	if multiHost:
+		sources = [iterRotationSet(None, filenames) for filenames in logs]
+		if lineFilter is not None:
+			sources = [lineFilter.lines(source) for source in sources]
+		logFile = mergeLogs(sources, references)
+	elif args.rotation_set:
+		logFile = iterRotationSet(mailLog, logs[0])
+	elif checkpoint is not None:
+		logFile = checkpoint.open(mailLog, filename)
+		print >>sys.stderr, "Checkpoint: {}".format(checkpoint.status)
+	else:
+		logFile = openLog(filename)
+
+	lines = logFile
+	if lineFilter is not None and not multiHost:
+		lines = lineFilter.lines(logFile)
+
+	if args.mmap:
+		messages = mailLog.iterBufferedMessages(logFile, reference)
+	else:
+		messages = mailLog.iterMessages(lines, reference, args.workers)
+
+	try:
+		if args.db:
+			store = MessageStore(args.db)
+			for msg in messages:
+				store.add(msg)
+			store.close()
+
+		elif args.stream:
+			for msg in messages:
+				print msg
+				sys.stdout.flush()
+
+		else:
+			for msg in messages:
+				pass
+
+	finally:
+		logFile.close()
+
+	if args.rotation_set and not multiHost:
+		print >>sys.stderr, "Recovered {} messages that span files".format(mailLog.recoveredMessages)
+
+	if isinstance(logFile, BackgroundReader):
+		print >>sys.stderr, "Decompression: {}".format(logFile.stats())
+
+	if checkpoint is not None:
+		checkpoint.save(mailLog)
+
+	reportProfile(mailLog)
+	reportDelays()
+	saveEvents()
+	if quarantine is not None:
+		quarantine.close()
+	if lineFilter is not None:
+		print >>sys.stderr, "Pre-filter dropped: {}".format(lineFilter.report())
+
+	if args.stream or args.db:
+		return
+
+	if args.expire is not None:
+		print "Expired {} processes and {} messages".format(mailLog.expiredCounters["processes"], mailLog.expiredCounters["messages"])
 
 #	print "Processed messages..."
 #	mailLog.dumpProcessedMessages()
@@ -1646,4 +5617,4 @@ def main(filename):
 	#mailLog.dumpLogWithQueueID("46641321B67")
 
 if __name__ == '__main__':
-	main(sys.argv[1])
+	main(sys.argv[1:])
@@ -0,0 +1,431 @@
+#!/usr/bin/python
+
+"""
+Throughput benchmark for LogParser.
+
+Parses each given log file, or tests/*.log if no file is given, and
+reports lines per second, peak resident memory and time spent in every
+stage (parsing, consolidation by message ID, connecting automatically
+generated messages and dumping). A large synthetic log is built by
+concatenating the test logs a number of times, which is possible since
+every test log contains complete message flows, or by MailLogGenerator.
+
+Results can be appended to a file, one JSON object per line, together
+with the commit they were measured on, and compared across commits with
+--history.
+"""
+
+import sys
+import os
+import glob
+import time
+import json
+import resource
+import tempfile
+import argparse
+import gzip
+import shutil
+import platform
+import subprocess
+
+import LogParser
+import MailLogGenerator
+
+STAGES = ("parse", "consolidate", "connect", "dump")
+
+def countLines(filename):
+	with open(filename) as f:
+		return sum(1 for line in f)
+
+def buildSyntheticLog(filenames, repeat):
+	"""
+	Concatenate given log files repeat times into a temporary file and
+	return its name.
+	"""
+
+	fd, name = tempfile.mkstemp(prefix="LogParserBenchmark-", suffix=".log")
+	with os.fdopen(fd, "w") as out:
+		data = "".join(open(filename).read() for filename in filenames)
+		for i in xrange(repeat):
+			out.write(data)
+
+	return name
+
+def buildGeneratedLog(messages, seed):
+	"""
+	Generate a log with the given number of message flows into a
+	temporary file and return its name.
+	"""
+
+	fd, name = tempfile.mkstemp(prefix="LogParserBenchmark-", suffix=".log")
+	with os.fdopen(fd, "w") as out:
+		for line in MailLogGenerator.MailLogGenerator(seed=seed).lines(messages):
+			out.write(line)
+
+	return name
+
+def compressLog(filename):
+	"""
+	Make a gzip compressed copy of a log into a temporary file and return
+	its name.
+	"""
+
+	fd, name = tempfile.mkstemp(prefix="LogParserBenchmark-", suffix=".log.gz")
+	os.close(fd)
+	with open(filename, "rb") as f:
+		out = gzip.open(name, "wb")
+		shutil.copyfileobj(f, out)
+		out.close()
+
+	return name
+
+def parseInChild(filename, options, workers=None, buffered=False):
+	"""
+	Parse a file in a child process, so that peak memory of a single run
+	can be measured. Options are passed to ZimbraMailLog. Compressed
+	files are read by a BackgroundReader (see openLog). If buffered is
+	True, the file is memory mapped and parsed by iterBufferedMessages
+	instead of being read line by line. Returns the time
+	in seconds of every stage and peak resident memory in kilobytes (of
+	the parsing process only, not of its workers). Stages after parsing
+	need processed messages, so they are skipped if those aren't retained.
+	"""
+
+	r, w = os.pipe()
+	pid = os.fork()
+	if pid == 0:
+		os.close(r)
+
+		# parseLog prints progress every 10000 lines, and dumps go to
+		# standard output
+		sys.stderr = open(os.devnull, "w")
+		sys.stdout = open(os.devnull, "w")
+
+		# The child must not return into the caller, whatever happens, so
+		# a failed parse is reported by the parent instead
+		try:
+			stages = {}
+			mailLog = LogParser.ZimbraMailLog(**options)
+
+			start = time.time()
+			if buffered:
+				for msg in mailLog.iterBufferedMessages(LogParser.openLog(filename)):
+					pass
+			else:
+				mailLog.parseLog(LogParser.openLog(filename), workers=workers)
+			stages["parse"] = time.time() - start
+
+			if options.get("retainProcessed", True):
+				start = time.time()
+				mailLog.consolidateMessagesByMessageID()
+				stages["consolidate"] = time.time() - start
+
+				start = time.time()
+				mailLog.connectAutomaticallyGeneratedMessages()
+				stages["connect"] = time.time() - start
+
+				start = time.time()
+				mailLog.dumpMessagesByMessageID()
+				stages["dump"] = time.time() - start
+
+			os.write(w, json.dumps([stages, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss]))
+			os._exit(0)
+		except BaseException:
+			os._exit(1)
+
+	os.close(w)
+	result = os.read(r, 4096)
+	os.close(r)
+	os.waitpid(pid, 0)
+
+	if not result:
+		raise RuntimeError("Parsing {} failed".format(filename))
+
+	stages, maxrss = json.loads(result)
+	return stages, maxrss
+
+def timeParse(filename, rounds, options, workers=None, buffered=False):
+	"""
+	Parse a file rounds times and return the best time in seconds of
+	every stage and the peak resident memory in kilobytes.
+	"""
+
+	best = {}
+	for i in xrange(rounds):
+		stages, maxrss = parseInChild(filename, options, workers, buffered)
+		for stage, elapsed in stages.iteritems():
+			if stage not in best or elapsed < best[stage]:
+				best[stage] = elapsed
+
+	return best, maxrss
+
+def report(name, lines, (stages, maxrss), results=None):
+	elapsed = stages["parse"]
+	print "{:<40} {:>10} lines {:>8.3f} s {:>12.0f} lines/s {:>8.1f} MB RSS".format(name, lines, elapsed, lines / elapsed, maxrss / 1024.0)
+	if len(stages) > 1:
+		print "{:<40} {}".format("", "  ".join("{} {:.3f} s".format(stage, stages[stage]) for stage in STAGES if stage in stages))
+
+	if results is not None:
+		results.append({
+			"log": name,
+			"lines": lines,
+			"linesPerSecond": lines / elapsed,
+			"maxrss": maxrss,
+			"stages": stages,
+		})
+
+def checkFastPath(filenames):
+	"""
+	Parse every line of the files by the fast path of LogParser and by
+	the rules alone, and compare the rule, the end of the match and the
+	values of the fields. Prints the number of lines the fast path took
+	by rule, and the lines where the two disagree. Returns the number of
+	disagreements and of fast path rules that didn't take any line, so
+	a fast path that leaves lines to the rules by mistake is noticed too.
+	"""
+
+	mailLog = LogParser.ZimbraMailLog()
+	taken = {}
+	left = 0
+	mismatches = 0
+
+	for filename in filenames:
+		for line in open(filename):
+			hdr = mailLog.header.match(line)
+			if hdr is None:
+				continue
+
+			fast = mailLog.fastPath.match(hdr.group(3), line, hdr.end())
+			if fast is None:
+				left += 1
+				continue
+
+			regex, groups = mailLog.matchLine(line, None, hdr)
+			expected = None
+			if regex is not None:
+				expected = (regex["name"], len(groups[0]), regex["extract"](groups)[4:])
+
+			regex, end, values = fast
+			if (regex["name"], end, values) != expected:
+				mismatches += 1
+				if mismatches <= 10:
+					print "MISMATCH {}".format(line.rstrip("\n"))
+					print "  fast path: {}".format((regex["name"], end, values))
+					print "  rules:     {}".format(expected)
+				continue
+
+			taken[regex["name"]] = taken.get(regex["name"], 0) + 1
+
+	missing = [regex["name"] for regex in mailLog.fastPath.rules if regex["name"] not in taken]
+
+	for name in sorted(taken):
+		print "{:<40} {:>10} lines".format(name, taken[name])
+	for name in missing:
+		print "{:<40} {:>10} lines (not taken)".format(name, 0)
+	print "{:<40} {:>10} lines".format("(left to the rules)", left)
+	print "{:<40} {:>10} lines".format("(mismatches)", mismatches)
+
+	return mismatches + len(missing)
+
+def parseMessages(lines, lineFilter=None):
+	"""
+	Parse lines, through lineFilter if given, and return the printout of
+	every done message by its queue ID, and the senders of the messages.
+	"""
+
+	mailLog = LogParser.ZimbraMailLog()
+	if lineFilter is not None:
+		lines = lineFilter.lines(iter(lines))
+
+	messages = {}
+	senders = set()
+	for msg in mailLog.iterMessages(lines):
+		messages[msg.getQueueID()] = str(msg)
+		if msg.getMailFrom():
+			senders.add(msg.getMailFrom())
+
+	return messages, senders
+
+def checkTarget(filenames):
+	"""
+	Parse every log targeted at each of its queue IDs and senders (see
+	--target of LogParser), and check that the targeted messages are the
+	same as in the complete parse. Every log is also checked with its
+	first queue ID replaced by one of digits only, which postfix makes
+	too. Prints the lines where they differ, and returns the number of
+	differences.
+	"""
+
+	mismatches = 0
+	for filename in filenames:
+		lines = open(filename).readlines()
+		lineFilter = LogParser.LineFilter()
+		queueid = next((queueid for queueid in (lineFilter.queueIDOf(line, line.find("]: ") + 3) for line in lines) if queueid), None)
+		variants = [(filename, lines)]
+		if queueid is not None:
+			variants.append(("{} ({} as 12345678901)".format(filename, queueid), [line.replace(queueid, "12345678901") for line in lines]))
+
+		for name, lines in variants:
+			full, senders = parseMessages(lines)
+			for needle in sorted(full) + sorted(senders):
+				lineFilter = LogParser.LineFilter((), [needle])
+				lineFilter.discover(lambda: iter(lines))
+				targeted, targetedSenders = parseMessages(lines, lineFilter)
+
+				expected = [queueid for queueid in full if needle == queueid or needle in full[queueid]]
+				for queueid in expected:
+					if targeted.get(queueid) != full[queueid]:
+						mismatches += 1
+						print "MISMATCH {} --target {}".format(name, needle)
+						print "  targeted: {}".format(targeted.get(queueid))
+						print "  complete: {}".format(full[queueid])
+
+			print "{:<60} {:>6} messages".format(name, len(full))
+
+	print "{:<60} {:>6}".format("(mismatches)", mismatches)
+
+	return mismatches
+
+def currentCommit():
+	"""
+	Return the commit of the working tree, with "-dirty" appended if it
+	has uncommitted changes, or None outside of a git repository.
+	"""
+
+	directory = os.path.dirname(os.path.abspath(__file__))
+	try:
+		commit = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=directory, stderr=open(os.devnull, "w")).strip()
+		if subprocess.call(["git", "diff", "--quiet", "HEAD"], cwd=directory) != 0:
+			commit += "-dirty"
+	except (OSError, subprocess.CalledProcessError):
+		return None
+	return commit
+
+def storeResults(filename, results, options):
+	"""
+	Append results to a file, one JSON object per line.
+	"""
+
+	common = {
+		"commit": currentCommit(),
+		"date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+		"python": platform.python_version(),
+		"options": options,
+	}
+
+	with open(filename, "a") as out:
+		for result in results:
+			result.update(common)
+			out.write(json.dumps(result, sort_keys=True) + "\n")
+
+def showHistory(filename):
+	"""
+	Print stored results of every log in the order they were measured, with
+	change of throughput relative to the previous result.
+	"""
+
+	byLog = {}
+	for line in open(filename):
+		result = json.loads(line)
+		byLog.setdefault(result["log"], []).append(result)
+
+	for log in sorted(byLog):
+		print log
+		previous = None
+		for result in byLog[log]:
+			change = ""
+			if previous is not None:
+				change = "{:+.1f}%".format(100.0 * (result["linesPerSecond"] / previous - 1))
+			stages = "  ".join("{} {:.3f}".format(stage, result["stages"][stage]) for stage in STAGES if stage in result["stages"])
+			print "  {:<14} {:<19} {:>12.0f} lines/s {:>8} {:>8.1f} MB  {}".format(result["commit"], result["date"], result["linesPerSecond"], change, result["maxrss"] / 1024.0, stages)
+			previous = result["linesPerSecond"]
+
+def main(argv):
+
+	parser = argparse.ArgumentParser(description="Measure LogParser throughput")
+	parser.add_argument("-n", "--rounds", type=int, default=3, help="number of rounds, the best one is reported")
+	parser.add_argument("-r", "--repeat", type=int, default=5000, help="how many times test logs are repeated in the synthetic log")
+	parser.add_argument("--offsets", action="store_true", help="keep only offsets of lines in log records")
+	parser.add_argument("--no-fast-path", action="store_true", help="match every line by the rules, without the fast path")
+	parser.add_argument("--no-retain", action="store_true", help="don't keep processed messages in memory")
+	parser.add_argument("--workers", metavar="N[,N...]", help="also parse the synthetic log with N worker processes, e.g. 1,2,4")
+	parser.add_argument("--mmap", action="store_true", help="also parse every log memory mapped, see --mmap of LogParser")
+	parser.add_argument("--generate", metavar="N", type=int, help="also parse a log of N message flows made by MailLogGenerator")
+	parser.add_argument("--seed", type=int, default=0, help="seed of the generated log (default 0)")
+	parser.add_argument("--check-fast-path", action="store_true", help="check that the fast path and the rules agree on the logs and a generated log (--generate, default 20000 flows, 0 for none), and exit")
+	parser.add_argument("--check-target", action="store_true", help="check that parsing targeted at every queue ID and sender of the logs gives the same messages as the complete parse, and exit")
+	parser.add_argument("--results", metavar="FILE", help="append results to FILE, one JSON object per line")
+	parser.add_argument("--history", metavar="FILE", help="show results stored in FILE and exit")
+	parser.add_argument("logs", nargs="*", help="log files to parse (default tests/*.log)")
+	args = parser.parse_args(argv)
+
+	if args.history:
+		showHistory(args.history)
+		return
+
+	options = {}
+	if args.offsets:
+		options["keepLines"] = False
+	if args.no_retain:
+		options["retainProcessed"] = False
+	if args.no_fast_path:
+		options["fastPath"] = False
+
+	logs = args.logs
+	if not logs:
+		logs = sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), "tests", "*.log")))
+
+	if args.check_fast_path:
+		if args.generate == 0:
+			sys.exit(1 if checkFastPath(logs) else 0)
+		generated = buildGeneratedLog(args.generate or 20000, args.seed)
+		try:
+			mismatches = checkFastPath(logs + [generated])
+		finally:
+			os.unlink(generated)
+		sys.exit(1 if mismatches else 0)
+
+	if args.check_target:
+		sys.exit(1 if checkTarget(logs) else 0)
+
+	results = []
+
+	def measure(name, filename, lines, workers=None):
+		report(name, lines, timeParse(filename, args.rounds, options, workers), results)
+		if args.mmap and not workers:
+			report(name + ", mmap", lines, timeParse(filename, args.rounds, options, buffered=True), results)
+
+	for filename in logs:
+		measure(os.path.basename(filename), filename, countLines(filename))
+
+	if args.repeat:
+		synthetic = buildSyntheticLog(logs, args.repeat)
+		try:
+			lines = countLines(synthetic)
+			measure("synthetic ({} x corpus)".format(args.repeat), synthetic, lines)
+
+			if args.workers:
+				# Workers take lines in chunks, which has to work with
+				# compressed logs too
+				compressed = compressLog(synthetic)
+				try:
+					for workers in [int(n) for n in args.workers.split(",")]:
+						measure("synthetic, {} workers".format(workers), synthetic, lines, workers)
+						measure("synthetic.gz, {} workers".format(workers), compressed, lines, workers)
+				finally:
+					os.unlink(compressed)
+		finally:
+			os.unlink(synthetic)
+
+	if args.generate:
+		generated = buildGeneratedLog(args.generate, args.seed)
+		try:
+			measure("generated ({} flows, seed {})".format(args.generate, args.seed), generated, countLines(generated))
+		finally:
+			os.unlink(generated)
+
+	if args.results:
+		storeResults(args.results, results, options)
+
+if __name__ == '__main__':
+	main(sys.argv[1:])
@@ -0,0 +1,380 @@
+#!/usr/bin/python
+
+"""
+Generator of synthetic Zimbra postfix mail logs.
+
+Generated logs follow the message flows modeled by the state machines in
+LogParser, i.e. PostfixProcess, AmavisdProcess, DKIMMilterProcess and
+MailMessage, using line formats of the zimbra8 rules:
+
+	inbound		client connects, message is scanned by amavis
+			(10024) and reinjected, then delivered over lmtp
+	spam		like inbound, but amavis discards the message
+	outbound	authenticated user sends a message that is signed
+			by dkim milter (10026) and reinjected, then relayed
+			to remote servers; delivery to some recipients is
+			deferred and retried, and some bounce, which
+			generates a delivery status notification
+	sasl failure	client fails to authenticate and disconnects
+	reject		client is rejected and disconnects
+
+Flows of different messages overlap in time as they do in a real log, so
+the log is internally consistent: every queue ID is created, delivered
+and removed, and every smtpd process connects and disconnects. Arrivals
+follow a Poisson process with the given rate.
+"""
+
+import sys
+import random
+import heapq
+import argparse
+import calendar
+from datetime import datetime
+
+MONTHS = ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
+
+LOCAL_DOMAIN = "example.com"
+LOCAL_USERS = ["user{}".format(i) for i in xrange(200)]
+REMOTE_DOMAINS = ["example.net", "example.org", "company.com", "mail.example-domain.com", "isp.example.hr"]
+
+class MailLogGenerator():
+	"""
+	Generate lines of a synthetic mail log. Mix gives the probability of
+	every kind of flow (see FLOWS), while defer and bounce are the
+	probabilities that delivery of an outbound message to a recipient is
+	deferred or bounced.
+	"""
+
+	FLOWS = ("inbound", "spam", "outbound", "saslFailure", "reject")
+
+	DEFAULT_MIX = {
+		"inbound": 0.55,
+		"spam": 0.1,
+		"outbound": 0.2,
+		"saslFailure": 0.05,
+		"reject": 0.1,
+	}
+
+	def __init__(self, hostname="mail", start=datetime(2013, 9, 22), rate=2.0,
+			mix=None, defer=0.1, bounce=0.05, seed=None):
+
+		self.hostname = hostname
+		self.start = calendar.timegm(start.timetuple())
+		self.rate = rate
+		self.defer = defer
+		self.bounce = bounce
+		self.random = random.Random(seed)
+
+		mix = dict(self.DEFAULT_MIX, **(mix or {}))
+		total = float(sum(mix[flow] for flow in self.FLOWS))
+		self.cumulative = []
+		accumulated = 0.0
+		for flow in self.FLOWS:
+			accumulated += mix[flow] / total
+			self.cumulative.append((accumulated, getattr(self, flow)))
+
+		# Pending lines as (time, sequence, program, pid, text)
+		self.events = []
+		self.sequence = 0
+
+		# Time until which every PID is used by a process
+		self.pids = {}
+
+		# Long running processes
+		self.qmgrPID = self.newPID(0, float("inf"))
+		self.cleanupPIDs = [self.newPID(0, float("inf")) for i in xrange(4)]
+
+		self.lastSecond = None
+		self.lastTimestamp = None
+
+	# Identifiers
+
+	def newPID(self, now, until):
+		while True:
+			pid = self.random.randint(300, 32767)
+			if self.pids.get(pid, -1) < now:
+				self.pids[pid] = until
+				return pid
+
+	def newQueueID(self):
+		return "{:010X}".format(self.random.getrandbits(40))
+
+	def newMessageID(self, now, domain):
+		return "<{}.{:08X}@{}>".format(int(self.start + now), self.random.getrandbits(32), domain)
+
+	def newClient(self):
+		ip = "{}.{}.{}.{}".format(self.random.randint(11, 223), self.random.randint(0, 255), self.random.randint(0, 255), self.random.randint(1, 254))
+		if self.random.random() < 0.3:
+			return "unknown", ip
+		return "host-{}.{}".format(ip.replace(".", "-"), self.random.choice(REMOTE_DOMAINS)), ip
+
+	def remoteAddress(self):
+		return "user{}@{}".format(self.random.randint(0, 9999), self.random.choice(REMOTE_DOMAINS))
+
+	def delays(self, total):
+		# Time before the queue manager, in the queue manager, connection
+		# setup and transmission, as random shares of total
+		shares = [self.random.random() for i in xrange(4)]
+		delays = [round(total * share / sum(shares), 2) for share in shares]
+		return "delay={:.2f}, delays={}".format(sum(delays), "/".join("{:.2f}".format(delay) for delay in delays))
+
+	# Output
+
+	def emit(self, now, program, pid, text):
+		self.sequence += 1
+		heapq.heappush(self.events, (now, self.sequence, program, pid, text))
+
+	def timestamp(self, now):
+		second = int(self.start + now)
+		if second != self.lastSecond:
+			t = datetime.utcfromtimestamp(second)
+			self.lastSecond = second
+			self.lastTimestamp = "{} {:2d} {:02d}:{:02d}:{:02d}".format(MONTHS[t.month - 1], t.day, t.hour, t.minute, t.second)
+		return self.lastTimestamp
+
+	def format(self, event):
+		now, sequence, program, pid, text = event
+		return "{} {} {}[{}]: {}\n".format(self.timestamp(now), self.hostname, program, pid, text)
+
+	def lines(self, messages=None):
+		"""
+		Generate lines for the given number of flows, or forever, in time
+		order.
+		"""
+
+		now = 0.0
+		count = 0
+		while messages is None or count < messages:
+			now += self.random.expovariate(self.rate)
+			while self.events and self.events[0][0] <= now:
+				yield self.format(heapq.heappop(self.events))
+
+			choice = self.random.random()
+			for probability, flow in self.cumulative:
+				if choice <= probability:
+					break
+			flow(now)
+			count += 1
+
+		while self.events:
+			yield self.format(heapq.heappop(self.events))
+
+	# Flows
+
+	def connect(self, now, program, client):
+		"""
+		Connection to smtpd, returns the PID of the process and the time
+		when the client disconnects.
+		"""
+
+		duration = self.random.uniform(0.5, 5)
+		pid = self.newPID(now, now + duration)
+		self.emit(now, program, pid, "connect from {}[{}]".format(*client))
+		return pid, now + duration
+
+	def reinject(self, now, program, queueid):
+		"""
+		Reinjection of a message by content filter through a local smtpd.
+		"""
+
+		pid, end = self.connect(now, program, ("localhost", "127.0.0.1"))
+		self.emit(now, program, pid, "{}: client=localhost[127.0.0.1]".format(queueid))
+		self.emit(end, program, pid, "disconnect from localhost[127.0.0.1]")
+
+	def queued(self, now, queueid, messageid, sender, size, recipients):
+		self.emit(now, "postfix/cleanup", self.random.choice(self.cleanupPIDs), "{}: message-id={}".format(queueid, messageid))
+		self.emit(now + 0.01, "postfix/qmgr", self.qmgrPID, "{}: from=<{}>, size={}, nrcpt={} (queue active)".format(queueid, sender, size, len(recipients)))
+
+	def received(self, now, client, sender, recipients, sasl=None):
+		"""
+		Message received by smtpd and passed to amavis, returns the queue
+		ID and the time it was queued.
+		"""
+
+		pid, end = self.connect(now, "postfix/smtpd", client)
+		clientString = "{}[{}]".format(*client)
+
+		now += 0.1
+		for recipient in recipients:
+			for port in ((10026,) if sasl else (10026, 10024)):
+				self.emit(now, "postfix/smtpd", pid, "NOQUEUE: filter: RCPT from {}: <{}>: Sender address triggers FILTER smtp-amavis:[127.0.0.1]:{}; from=<{}> to=<{}> proto=ESMTP helo=<{}>".format(clientString, sender, port, sender, recipient, client[0]))
+
+		queueid = self.newQueueID()
+		if sasl:
+			self.emit(now, "postfix/smtpd", pid, "{}: client={}, sasl_method=PLAIN, sasl_username={}".format(queueid, clientString, sasl))
+		else:
+			self.emit(now, "postfix/smtpd", pid, "{}: client={}".format(queueid, clientString))
+
+		self.emit(end, "postfix/smtpd", pid, "disconnect from {}".format(clientString))
+		return queueid, now
+
+	def inbound(self, now, spam=False):
+		client = self.newClient()
+		sender = self.remoteAddress()
+		recipients = ["{}@{}".format(user, LOCAL_DOMAIN) for user in self.random.sample(LOCAL_USERS, self.random.choice((1, 1, 1, 2, 3)))]
+		messageid = self.newMessageID(now, client[0] if client[0] != "unknown" else self.random.choice(REMOTE_DOMAINS))
+		size = self.random.randint(1000, 200000)
+
+		queueid, now = self.received(now, client, sender, recipients)
+		self.queued(now + 0.1, queueid, messageid, sender, size, recipients)
+
+		# Amavis scans the message
+		now += self.random.uniform(0.5, 5)
+		smtpPID = self.random.randint(300, 32767)
+		if spam:
+			for recipient in recipients:
+				self.emit(now, "postfix/smtp", smtpPID, "{}: to=<{}>, relay=127.0.0.1[127.0.0.1]:10024, {}, dsn=2.7.0, status=sent (250 2.7.0 Ok, discarded, id={}-{:02d} - spam)".format(queueid, recipient, self.delays(now % 10), smtpPID, self.random.randint(1, 99)))
+			self.emit(now, "postfix/qmgr", self.qmgrPID, "{}: removed".format(queueid))
+			return
+
+		child = self.newQueueID()
+		self.reinject(now - 0.2, "postfix/amavisd/smtpd", child)
+		self.queued(now - 0.1, child, messageid, sender, size + 400, recipients)
+		for recipient in recipients:
+			self.emit(now, "postfix/smtp", smtpPID, "{}: to=<{}>, relay=127.0.0.1[127.0.0.1]:10024, {}, dsn=2.0.0, status=sent (250 2.0.0 from MTA(smtp:[127.0.0.1]:10025): 250 2.0.0 Ok: queued as {})".format(queueid, recipient, self.delays(now % 10), child))
+		self.emit(now, "postfix/qmgr", self.qmgrPID, "{}: removed".format(queueid))
+
+		self.delivered(now + 0.1, child, recipients)
+
+	def delivered(self, now, queueid, recipients):
+		"""
+		Local delivery of a message over lmtp.
+		"""
+
+		lmtpPID = self.random.randint(300, 32767)
+		for recipient in recipients:
+			self.emit(now, "postfix/lmtp", lmtpPID, "{}: to=<{}>, relay=mail.{}[172.16.20.3]:7025, {}, dsn=2.1.5, status=sent (250 2.1.5 Delivery OK)".format(queueid, recipient, LOCAL_DOMAIN, self.delays(0.06)))
+		self.emit(now, "postfix/qmgr", self.qmgrPID, "{}: removed".format(queueid))
+
+	def spam(self, now):
+		self.inbound(now, spam=True)
+
+	def outbound(self, now):
+		user = self.random.choice(LOCAL_USERS)
+		sender = "{}@{}".format(user, LOCAL_DOMAIN)
+		client = ("unknown", "172.16.{}.{}".format(self.random.randint(0, 255), self.random.randint(1, 254)))
+		recipients = sorted(set(self.remoteAddress() for i in xrange(self.random.choice((1, 1, 2, 3)))))
+		messageid = self.newMessageID(now, LOCAL_DOMAIN)
+		size = self.random.randint(1000, 200000)
+
+		queueid, now = self.received(now, client, sender, recipients, sasl=user)
+		self.queued(now + 0.1, queueid, messageid, sender, size, recipients)
+
+		# Signed by dkim milter and reinjected
+		now += self.random.uniform(0.2, 1)
+		child = self.newQueueID()
+		self.reinject(now - 0.2, "postfix/dkimmilter/smtpd", child)
+		self.queued(now - 0.1, child, messageid, sender, size + 600, recipients)
+		smtpPID = self.random.randint(300, 32767)
+		for recipient in recipients:
+			self.emit(now, "postfix/smtp", smtpPID, "{}: to=<{}>, relay=127.0.0.1[127.0.0.1]:10026, {}, dsn=2.0.0, status=sent (250 2.0.0 from MTA(smtp:[127.0.0.1]:10030): 250 2.0.0 Ok: queued as {})".format(queueid, recipient, self.delays(now % 10), child))
+		self.emit(now, "postfix/qmgr", self.qmgrPID, "{}: removed".format(queueid))
+
+		# Relay to remote servers, deferred recipients are retried
+		done = now
+		bounced = []
+		for recipient in recipients:
+			t = now + self.random.uniform(0.5, 3)
+			domain = recipient.split("@")[1]
+			mx = "mx.{}".format(domain)
+			mxip = "{}.{}.{}.{}".format(self.random.randint(11, 223), self.random.randint(0, 255), self.random.randint(0, 255), self.random.randint(1, 254))
+
+			if self.random.random() < self.defer:
+				for retry in xrange(self.random.randint(1, 3)):
+					pid = self.random.randint(300, 32767)
+					self.emit(t, "postfix/smtp", pid, "connect to {}[{}]:25: Connection refused".format(domain, mxip))
+					self.emit(t, "postfix/smtp", pid, "{}: to=<{}>, relay=none, {}, dsn=4.4.1, status=deferred (connect to {}[{}]:25: Connection refused)".format(child, recipient, self.delays(t - now), domain, mxip))
+					t += self.random.uniform(300, 1200)
+
+			pid = self.random.randint(300, 32767)
+			if self.random.random() < self.bounce:
+				self.emit(t, "postfix/smtp", pid, "{}: to=<{}>, relay={}[{}]:25, {}, dsn=5.1.1, status=bounced (host {}[{}] said: 550 5.1.1 <{}>: Recipient address rejected: User unknown (in reply to RCPT TO command))".format(child, recipient, mx, mxip, self.delays(t - now), mx, mxip, recipient))
+				bounced.append(t)
+			else:
+				# Some servers tell their queue ID, others don't
+				if self.random.random() < 0.5:
+					reply = "250 2.0.0 Ok: queued as {:08X}".format(self.random.getrandbits(32))
+				else:
+					reply = "250 2.0.0 OK {} {:08x} - gsmtp".format(int(t), self.random.getrandbits(32))
+				self.emit(t, "postfix/smtp", pid, "{}: to=<{}>, relay={}[{}]:25, {}, dsn=2.0.0, status=sent ({})".format(child, recipient, mx, mxip, self.delays(t - now), reply))
+			done = max(done, t)
+
+		if bounced:
+			# Non-delivery notification is sent back to the sender
+			t = done + 0.01
+			dsn = self.newQueueID()
+			self.queued(t, dsn, self.newMessageID(t, "mail." + LOCAL_DOMAIN), "", 2000 + size // 10, [sender])
+			self.emit(t + 0.02, "postfix/bounce", self.random.randint(300, 32767), "{}: sender non-delivery notification: {}".format(child, dsn))
+			self.delivered(t + 0.05, dsn, [sender])
+			done = t + 0.03
+
+		self.emit(done + 0.01, "postfix/qmgr", self.qmgrPID, "{}: removed".format(child))
+
+	def saslFailure(self, now):
+		client = ("unknown", self.newClient()[1])
+		pid, end = self.connect(now, "postfix/smtpd", client)
+		for i in xrange(self.random.randint(1, 3)):
+			self.emit(now + 0.1 * (i + 1), "postfix/smtpd", pid, "warning: {}[{}]: SASL LOGIN authentication failed: authentication failure".format(*client))
+		self.emit(end - 0.01, "postfix/smtpd", pid, "lost connection after AUTH from {}[{}]".format(*client))
+		self.emit(end, "postfix/smtpd", pid, "disconnect from {}[{}]".format(*client))
+
+	def reject(self, now):
+		client = self.newClient()
+		pid, end = self.connect(now, "postfix/smtpd", client)
+		recipient = self.random.choice(LOCAL_USERS)
+		self.emit(now + 0.1, "postfix/smtpd", pid, "NOQUEUE: reject: RCPT from {}[{}]: 504 5.5.2 <{}>: Recipient address rejected: need fully-qualified address; from=<{}> to=<{}> proto=ESMTP helo=<{}>".format(client[0], client[1], recipient, self.remoteAddress(), recipient, client[0]))
+		self.emit(end - 0.01, "postfix/smtpd", pid, "lost connection after RCPT from {}[{}]".format(*client))
+		self.emit(end, "postfix/smtpd", pid, "disconnect from {}[{}]".format(*client))
+
+def parseSize(value):
+	"""
+	Parse size like 100M or 10G into bytes.
+	"""
+
+	units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+	if value[-1:].upper() in units:
+		return int(float(value[:-1]) * units[value[-1:].upper()])
+	return int(value)
+
+def main(argv):
+
+	parser = argparse.ArgumentParser(description="Generate a synthetic Zimbra postfix mail log")
+	parser.add_argument("-n", "--messages", type=int, help="number of flows to generate")
+	parser.add_argument("-s", "--size", type=parseSize, help="stop after SIZE bytes, e.g. 100M or 10G")
+	parser.add_argument("--rate", type=float, default=2.0, help="flows per second of log time (default 2)")
+	parser.add_argument("--seed", type=int, help="seed of the random generator, for reproducible logs")
+	parser.add_argument("--hostname", default="mail", help="host name in the log (default mail)")
+	parser.add_argument("--start", type=lambda value: datetime.strptime(value, "%Y-%m-%d"), default=datetime(2013, 9, 22), help="log start date, YYYY-MM-DD")
+	for flow in MailLogGenerator.FLOWS:
+		parser.add_argument("--" + flow, type=float, default=MailLogGenerator.DEFAULT_MIX[flow], help="share of {} flows (default {})".format(flow, MailLogGenerator.DEFAULT_MIX[flow]))
+	parser.add_argument("--defer", type=float, default=0.1, help="probability that outbound delivery is deferred (default 0.1)")
+	parser.add_argument("--bounce", type=float, default=0.05, help="probability that outbound delivery bounces (default 0.05)")
+	parser.add_argument("-o", "--output", help="output file, gzip compressed if it ends with .gz (default standard output)")
+	args = parser.parse_args(argv)
+
+	if args.messages is None and args.size is None:
+		parser.error("either --messages or --size is required")
+
+	mix = dict((flow, getattr(args, flow)) for flow in MailLogGenerator.FLOWS)
+	generator = MailLogGenerator(args.hostname, args.start, args.rate, mix, args.defer, args.bounce, args.seed)
+
+	if args.output is None:
+		output = sys.stdout
+	elif args.output.endswith(".gz"):
+		import gzip
+		output = gzip.open(args.output, "wb")
+	else:
+		output = open(args.output, "w")
+
+	written = 0
+	for line in generator.lines(args.messages):
+		output.write(line)
+		if args.size is not None:
+			written += len(line)
+			if written >= args.size:
+				break
+
+	output.close()
+
+if __name__ == '__main__':
+	main(sys.argv[1:])